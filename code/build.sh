@@ -1,8 +1,12 @@
+set -e
 echo "Copying lambda functions..."
 rm -rf ../infrastructure/code/*
 rsync -zavh ../code/ ../infrastructure/code/
 cd ../infrastructure/code/lambda_layer/pipeline/python
 pip3 install -r requirements.txt --target .
+# Compiled dependencies are fetched as wheels for the Lambda runtime
+# (Python 3.7 on x86_64 Linux), whatever the build host is
+pip3 install -r requirements-native.txt --target . --platform manylinux2014_x86_64 --python-version 3.7 --implementation cp --only-binary=:all:
 echo "Done building pipeline / registry layer!"
 cd ../../metadata-services/python
 pip3 install -r requirements.txt --target .
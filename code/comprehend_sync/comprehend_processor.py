@@ -1,25 +1,37 @@
 import os, sys
+import re
 import json
 import urllib.parse
 import boto3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from trp import Document
-from helper import S3Helper, AwsHelper, FileHelper
-from es import ESCluster
+from helper import S3Helper, AwsHelper, FileHelper, RateLimiter
+from es import ESCluster, normalizeEntities, normalizeForms, DEFAULT_DOCUMENT_VERSION
+from esbuffer import SQSQueue, enqueueDocuments
+from cache import createComprehendCache
 import requests
 from pprint import pprint
 from og import OutputGenerator
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 from requests_aws4auth import AWS4Auth
-from metadata import PipelineOperationsClient, DocumentLineageClient
+from metadata import PipelineOperationsClient, DocumentLineageClient, flushesMetadata
 
 PIPELINE_STAGE = "SYNC_PROCESS_COMPREHEND"
 
-COMPREHEND_CHARACTER_LIMIT = 4096
+# Comprehend limits are in UTF-8 bytes: batch items must be under 5,000 bytes
+# and a batch call takes at most 25 items
+COMPREHEND_BYTE_LIMIT = 4999
+COMPREHEND_BATCH_SIZE = 25
+COMPREHEND_MAX_CONCURRENCY = int(os.environ.get('COMPREHEND_MAX_CONCURRENCY', 8))
+COMPREHEND_MAX_TPS = float(os.environ.get('COMPREHEND_MAX_TPS', 10))
+SENTENCE_BOUNDARY = re.compile(r'[.!?]+["\')\]]*\s+|\n+')
 
 metadataTopic      = os.environ.get('METADATA_SNS_TOPIC_ARN', None)
 comprehendBucket   = os.environ.get('TARGET_COMPREHEND_BUCKET', None)
 esCluster          = os.environ.get('TARGET_ES_CLUSTER', None)
 esIndex            = os.environ.get('ES_CLUSTER_INDEX', "document")
+esIndexQueueUrl    = os.environ.get('ES_INDEX_QUEUE_URL', None)
 
 if not esCluster or not comprehendBucket or not metadataTopic:
     raise Exception("Missing arguments.")
@@ -27,6 +39,11 @@ if not esCluster or not comprehendBucket or not metadataTopic:
 pipeline_client = PipelineOperationsClient(metadataTopic)
 lineage_client  = DocumentLineageClient(metadataTopic)
 es              = ESCluster(host=esCluster)
+comprehendRateLimiter = RateLimiter(COMPREHEND_MAX_TPS)
+comprehendCache = createComprehendCache()
+# With an indexing queue configured, page documents are handed to the
+# es_indexer buffer instead of being bulk indexed per invocation
+esQueue         = SQSQueue(esIndexQueueUrl) if esIndexQueueUrl else None
 
 def dissectObjectName(objectName):
     objectParts = objectName.split("/ocr-analysis/")
@@ -35,77 +52,182 @@ def dissectObjectName(objectName):
     documentName = "/".join(objectPath[1:])
     return (documentId, documentName)
     
+def _splitOversized(text, start, end, byteLimit):
+    # Split a span with no sentence break small enough to fit: first on
+    # whitespace, then (for a single huge token) on character boundaries
+    tokens = [(m.start(), m.end()) for m in re.finditer(r'\S*\s*', text[start:end]) if m.end() > m.start()]
+    chunkStart = start
+    chunkBytes = 0
+    for tokenStart, tokenEnd in tokens:
+        tokenStart = tokenStart + start
+        tokenEnd = tokenEnd + start
+        tokenBytes = len(text[tokenStart:tokenEnd].encode('utf-8'))
+        if chunkBytes + tokenBytes <= byteLimit:
+            chunkBytes = chunkBytes + tokenBytes
+            continue
+        if tokenStart > chunkStart:
+            yield (chunkStart, tokenStart)
+        chunkStart = tokenStart
+        chunkBytes = 0
+        for index in range(tokenStart, tokenEnd):
+            charBytes = len(text[index].encode('utf-8'))
+            if chunkBytes + charBytes > byteLimit:
+                yield (chunkStart, index)
+                chunkStart = index
+                chunkBytes = 0
+            chunkBytes = chunkBytes + charBytes
+    if end > chunkStart:
+        yield (chunkStart, end)
+
+def iterTextChunks(text, byteLimit=COMPREHEND_BYTE_LIMIT):
+    # Yields (characterOffset, chunk) pairs covering the text, each at most
+    # byteLimit UTF-8 bytes, breaking on sentence ends and newlines where
+    # possible. Each character is measured once, so this is linear in the text.
+    boundaries = [m.end() for m in SENTENCE_BOUNDARY.finditer(text)]
+    if not boundaries or boundaries[-1] != len(text):
+        boundaries.append(len(text))
+    chunkStart = 0
+    chunkEnd = 0
+    chunkBytes = 0
+    for sentenceEnd in boundaries:
+        sentenceBytes = len(text[chunkEnd:sentenceEnd].encode('utf-8'))
+        if chunkBytes + sentenceBytes <= byteLimit:
+            chunkEnd = sentenceEnd
+            chunkBytes = chunkBytes + sentenceBytes
+            continue
+        if chunkEnd > chunkStart:
+            yield (chunkStart, text[chunkStart:chunkEnd])
+        if sentenceBytes <= byteLimit:
+            chunkStart = chunkEnd
+            chunkEnd = sentenceEnd
+            chunkBytes = sentenceBytes
+        else:
+            for spanStart, spanEnd in _splitOversized(text, chunkEnd, sentenceEnd, byteLimit):
+                yield (spanStart, text[spanStart:spanEnd])
+            chunkStart = sentenceEnd
+            chunkEnd = sentenceEnd
+            chunkBytes = 0
+    if chunkEnd > chunkStart:
+        yield (chunkStart, text[chunkStart:chunkEnd])
+
 def chunkUpTheText(text):
-    chunksOfText = []
-    while(len(text) > COMPREHEND_CHARACTER_LIMIT):
-        indexSnip = COMPREHEND_CHARACTER_LIMIT
-        while(not text[indexSnip].isspace()):
-            indexSnip += 1
-        chunksOfText.append(text[0:indexSnip])
-        text = text[indexSnip:]
-    chunksOfText.append(text)
-    return chunksOfText
-    
+    return [chunk for offset, chunk in iterTextChunks(text)]
+
+def packComprehendBatches(items, batchSize=COMPREHEND_BATCH_SIZE):
+    # Packs chunks from any number of pages into full batches for the
+    # Comprehend batch APIs
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batchSize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _raiseOnBatchErrors(response, api):
+    errors = response.get("ErrorList", [])
+    if errors:
+        raise Exception("{} failed for {} item(s): {}".format(api, len(errors), errors))
+
+def batchDetectKeyPhrases(comprehend, textList, language):
+    # Returns each text's key phrases (offsets relative to that text)
+    keyPhraseResults = [[] for text in textList]
+    comprehendRateLimiter.acquire()
+    keyphrase_response = comprehend.batch_detect_key_phrases(TextList=textList, LanguageCode=language)
+    _raiseOnBatchErrors(keyphrase_response, "BatchDetectKeyPhrases")
+    for keyphraseListResp in keyphrase_response.get("ResultList"):
+        keyPhraseResults[keyphraseListResp['Index']] = keyphraseListResp.get('KeyPhrases')
+    return keyPhraseResults
+
+def batchDetectEntities(comprehend, textList, language):
+    # Returns each text's entities (offsets relative to that text)
+    entityResults = [[] for text in textList]
+    comprehendRateLimiter.acquire()
+    detect_entity_response = comprehend.batch_detect_entities(TextList=textList, LanguageCode=language)
+    _raiseOnBatchErrors(detect_entity_response, "BatchDetectEntities")
+    for entitiesListResp in detect_entity_response.get("ResultList"):
+        entityResults[entitiesListResp['Index']] = entitiesListResp.get("Entities")
+    return entityResults
+
 def batchSendToComprehend(comprehend, textList, language):
-    keyPhrases = set()
-    entitiesDetected = {}
-    try:
-        keyphrase_response = comprehend.batch_detect_key_phrases(TextList=textList, LanguageCode=language)
-        keyphraseResultsList = keyphrase_response.get("ResultList")
-        for keyphraseListResp in keyphraseResultsList:
-            keyphraseList = keyphraseListResp.get('KeyPhrases')
-            for s in keyphraseList:
-                s_txt = s.get("Text").strip('\t\n\r')
-                print("Detected keyphrase {}".format(s_txt))
-                keyPhrases.add(s_txt)
-    except Exception as e:
-        pipeline_client.stageFailed("Could not batch detect key phrases in Comprehend")
-        raise(e)
-    try:
-        detect_entity_response = comprehend.batch_detect_entities(TextList=textList, LanguageCode=language)
-        entityResultsList = detect_entity_response.get("ResultList")
-        for entitiesListResp in entityResultsList:
-            entityList = entitiesListResp.get("Entities")
-            for s in entityList:
-                entitiesDetected.update([(s.get("Type").strip('\t\n\r'), s.get("Text").strip('\t\n\r'))])
-    except Exception as e:
-        pipeline_client.stageFailed("Could not batch detect entities in batch in Comprehend")
-        raise(e)
-    
-    return (list(keyPhrases), entitiesDetected)
+    # Returns (keyPhraseResults, entityResults), one entry per text in textList.
+    # Cached results are used where available; the remaining texts are packed
+    # into batches and both detectors run on a bounded thread pool, held under
+    # COMPREHEND_MAX_TPS calls per second. Results come back in input order.
+    detectors = [
+        (batchDetectKeyPhrases, "BatchDetectKeyPhrases", "Could not batch detect key phrases in Comprehend"),
+        (batchDetectEntities,   "BatchDetectEntities",   "Could not batch detect entities in batch in Comprehend")
+    ]
+    allResults = []
+    with ThreadPoolExecutor(max_workers=COMPREHEND_MAX_CONCURRENCY) as executor:
+        submitted = []
+        for detector, api, failureMessage in detectors:
+            results = [None] * len(textList)
+            if comprehendCache:
+                for index, result in comprehendCache.getMany(api, language, textList).items():
+                    results[index] = result
+            misses = [index for index, result in enumerate(results) if result is None]
+            futures = []
+            for batch in packComprehendBatches(misses):
+                futures.append((batch, executor.submit(detector, comprehend, [textList[index] for index in batch], language)))
+            allResults.append(results)
+            submitted.append((api, failureMessage, results, futures))
+
+        for api, failureMessage, results, futures in submitted:
+            for position, (batch, future) in enumerate(futures):
+                try:
+                    batchResults = future.result()
+                except Exception as e:
+                    for remaining in submitted:
+                        for pendingBatch, pending in remaining[3]:
+                            pending.cancel()
+                    pipeline_client.stageFailed(failureMessage)
+                    raise(e)
+                for index, result in zip(batch, batchResults):
+                    results[index] = result
+                if comprehendCache:
+                    comprehendCache.putMany(api, language, [textList[index] for index in batch], batchResults)
+    if comprehendCache:
+        print("Comprehend cache stats for this document: {}".format(comprehendCache.stats(reset=True)))
+    return (allResults[0], allResults[1])
+
+def collectComprehendResults(pageResult, offset, keyPhrases, entities):
+    # Folds one chunk's results into its page, shifting offsets so that they
+    # are relative to the page text
+    for s in keyPhrases:
+        s_txt = s.get("Text").strip('\t\n\r')
+        print("Detected keyphrase {}".format(s_txt))
+        pageResult["KeyPhrases"][s_txt] = None
+        pageResult["Mentions"].append({
+            "Kind":        "KEY_PHRASE",
+            "Text":        s_txt,
+            "BeginOffset": offset + s.get("BeginOffset", 0),
+            "EndOffset":   offset + s.get("EndOffset", 0)
+        })
+    for s in entities:
+        entityType = s.get("Type").strip('\t\n\r')
+        entityText = s.get("Text").strip('\t\n\r')
+        pageResult["Entities"].add((entityType, entityText))
+        pageResult["Mentions"].append({
+            "Kind":        "ENTITY",
+            "Type":        entityType,
+            "Text":        entityText,
+            "BeginOffset": offset + s.get("BeginOffset", 0),
+            "EndOffset":   offset + s.get("EndOffset", 0)
+        })
 
-def singularSendToComprehend(comprehend, text, language):
-    keyPhrases = set()
-    entitiesDetected = {}
-    try:
-        keyphrase_response = comprehend.detect_key_phrases(Text=text, LanguageCode=language)
-        keyphraseList = keyphrase_response.get("KeyPhrases")
-        for s in keyphraseList:
-            s_txt = s.get("Text").strip('\t\n\r')
-            print("Detected keyphrase {}".format(s_txt))
-            keyPhrases.add(s_txt)
-    except Exception as e:
-        pipeline_client.stageFailed("Could not detect key phrases in Comprehend")
-        raise(e)
-    try:
-        detect_entity = comprehend.detect_entities(Text=text, LanguageCode=language)
-        entityList = detect_entity.get("Entities")
-        for s in entityList:
-            entitiesDetected.update([(s.get("Type").strip('\t\n\r'),s.get("Text").strip('\t\n\r'))])
-    except Exception as e:
-        pipeline_client.stageFailed("Could not detect entities in Comprehend")
-        raise(e)
-    
-    return (list(keyPhrases), entitiesDetected)
-    
 def runComprehend(bucketName, objectName, callerId):
     
     comprehend = AwsHelper().getClient('comprehend')
     documentId, documentName = dissectObjectName(objectName)
-    assert (documentId == S3Helper().getTagsS3(bucketName, objectName).get('documentId', None)), "File path {} does not match the expected documentId tag of the object triggered.".format(objectName)
+    tags = S3Helper().getTagsS3(bucketName, objectName)
+    assert (documentId == tags.get('documentId', None)), "File path {} does not match the expected documentId tag of the object triggered.".format(objectName)
+    documentVersion = tags.get('documentVersion', DEFAULT_DOCUMENT_VERSION)
     
     textractOutputJson = json.loads(S3Helper().readFromS3(bucketName, objectName))
-    og = OutputGenerator(response=textractOutputJson, forms=False, tables=False)
+    document = Document(textractOutputJson, lazy=True)
+    og = OutputGenerator(response=textractOutputJson, forms=False, tables=False, document=document)
     
     pipeline_client.body = {
         "documentId": documentId,
@@ -115,45 +237,51 @@ def runComprehend(bucketName, objectName, callerId):
     }
     pipeline_client.stageInProgress()    
     
-    document = Document(textractOutputJson)
     originalFileName = "{}/{}".format(documentId, documentName)
     comprehendFileName = originalFileName + "/comprehend-output.json"
     comprehendFileS3Url = "https://{}.s3.amazonaws.com/{}".format(comprehendBucket, urllib.parse.quote_plus(comprehendFileName, safe="/"))
-    tagging = "documentId={}".format(documentId)
+    tagging = S3Helper.documentTagging(documentId, tags.get('documentVersion', None))
     
-    es.connect()
-    esPayload = []
+    pageResults = []
+    chunks = []
     page_num = 1
-    for page in document.pages:
-        table = og.structurePageTable(page)
-        forms = og.structurePageForm(page)
+    for page in document.iterPages(release=True):
         text = og.structurePageText(page)
-
-        keyPhrases = []
-        entitiesDetected = {}
-        
-        lenOfEncodedText = len(text)
         print("Comprehend documentId {} processing page {}".format(documentId, str(page_num)))
-        print("Length of encoded text is " + str(lenOfEncodedText))
-        if lenOfEncodedText == 0:
-            pass
-        elif lenOfEncodedText > COMPREHEND_CHARACTER_LIMIT:
-            print("Size was too big to run singularly; breaking up the page text into chunks")
-            try:
-                chunksOfText = chunkUpTheText(text)
-            except Exception as e:
-                pipeline_client.stageFailed("Could not determine how to snip the text on page {} into chunks.".format(page_num))
-                raise(e)
-            keyPhrases, entitiesDetected = batchSendToComprehend(comprehend, chunksOfText, 'en')
-        else:
-            keyPhrases, entitiesDetected = singularSendToComprehend(comprehend, text, 'en')
-            
-        esPageLoad = compileESPayload(es, page_num, keyPhrases, entitiesDetected, text, table, forms, documentId)
-        esPayload.append(esPageLoad)
+        print("Length of encoded text is " + str(len(text.encode('utf-8'))))
+        pageResults.append({
+            "table":      og.structurePageTable(page),
+            "forms":      og.structurePageForm(page),
+            "text":       text,
+            "KeyPhrases": OrderedDict(), # deduped, in first-seen order
+            "Entities":   set(),
+            "Mentions":   []
+        })
+        try:
+            for offset, chunk in iterTextChunks(text):
+                if chunk.strip():
+                    chunks.append((page_num, offset, chunk))
+        except Exception as e:
+            pipeline_client.stageFailed("Could not determine how to snip the text on page {} into chunks.".format(page_num))
+            raise(e)
         page_num = page_num + 1
+
+    keyPhraseResults, entityResults = batchSendToComprehend(comprehend, [chunk[2] for chunk in chunks], 'en')
+    for index, (chunkPage, offset, chunk) in enumerate(chunks):
+        collectComprehendResults(pageResults[chunkPage - 1], offset, keyPhraseResults[index], entityResults[index])
+    print("Processed {} chunks over {} pages with Comprehend".format(len(chunks), len(pageResults)))
+
+    esPayload = []
+    for index, pageResult in enumerate(pageResults):
+        esPageLoad = compileESPayload(es, index + 1, list(pageResult["KeyPhrases"]), pageResult["Entities"], pageResult["text"], pageResult["table"], pageResult["forms"], documentId, pageResult["Mentions"], documentName, documentVersion)
+        esPayload.append(esPageLoad)
     
     try:
-        es.post_bulk(index=esIndex, payload=esPayload)
+        directPayload = esPayload
+        if esQueue:
+            directPayload = enqueueDocuments(esQueue, esIndex, esPayload)
+        if directPayload:
+            es.post_pages(esIndex, directPayload)
     except Exception as e:
         pipeline_client.stageFailed("Could not post to Elasticsearch")
         raise(e)
@@ -176,19 +304,25 @@ def runComprehend(bucketName, objectName, callerId):
     pipeline_client.stageSucceeded()
     print("Comprehend data uploaded to S3 at {}".format(comprehendFileName))
     
-def compileESPayload(esCluster, pageNum, keyPhrases, entitiesDetected, text, table, forms, documentId):
+def compileESPayload(esCluster, pageNum, keyPhrases, entitiesDetected, text, table, forms, documentId, mentions=None, documentName=None, version=DEFAULT_DOCUMENT_VERSION):
     payload = {
         'documentId': documentId,
+        'version'   : version,
         'page'      : pageNum,
         'KeyPhrases': keyPhrases,
-        'Entities'  : entitiesDetected,
+        'Entities'  : normalizeEntities(entitiesDetected),
         'text'      : text,
         'table'     : table,
-        'forms'     : forms
+        'forms'     : normalizeForms(forms)
     }
+    if documentName is not None:
+        payload['documentName'] = documentName
+    if mentions is not None:
+        payload['Mentions'] = mentions
     pprint(payload)
     return payload
 
+@flushesMetadata
 def lambda_handler(event, context):
     print("Comprehend Event: {}".format(event))
 
@@ -2,7 +2,7 @@ import json
 import os
 import uuid
 import urllib.parse
-from metadata import PipelineOperationsClient
+from metadata import PipelineOperationsClient, flushesMetadata
 from helper import FileHelper, S3Helper, DynamoDBHelper
 
 PIPELINE_STAGE = "DOCUMENT_CLASSIFIER"
@@ -70,6 +70,7 @@ def startNLPProcessing(bucketName, objectName, documentId):
         'message': output
     }
 
+@flushesMetadata
 def lambda_handler(event, context):
 
     print("event: {}".format(event))
@@ -2,14 +2,20 @@ import json
 import os
 import uuid
 import urllib.parse
-from metadata import DocumentRegistryClient, DocumentLineageClient
+from metadata import DocumentRegistryClient, DocumentLineageClient, flushesMetadata
 from helper import FileHelper, S3Helper
+from es import ESCluster
 
 metadataTopic  = os.environ.get('METADATA_SNS_TOPIC_ARN', None)
+esCluster      = os.environ.get('TARGET_ES_CLUSTER', None)
+esIndex        = os.environ.get('ES_CLUSTER_INDEX', "document")
 
 if not metadataTopic:
     raise ValueError("Missing arguments.")
 
+# Optional: without a cluster, removed documents are only recorded in lineage
+es = ESCluster(host=esCluster) if esCluster else None
+
 ## The body should be customized with the document Metadata to then allow for the objects to be relayed (or not)
 ## Body could be assessed from existing S3 object metadata
 ## to the NLP pipeline.
@@ -32,7 +38,10 @@ def processCreateRequest(bucketName, documentName, documentVersion, principalIAM
   
     print("Input Object: {}/{} version {}".format(bucketName, documentName, documentVersion))
     print("Tagging object {} with tag {} and version {}".format(documentName, documentId, documentVersion))
-    S3Helper().tagS3(bucketName, documentName, tags={"documentId": documentId})
+    tags = {"documentId": documentId}
+    if documentVersion:
+        tags["documentVersion"] = documentVersion
+    S3Helper().tagS3(bucketName, documentName, tags=tags)
     try:
         documentLink = "s3://" + bucketName + "/" + urllib.parse.quote_plus(documentName)
         registryItem = {
@@ -74,12 +83,17 @@ def processDeleteRequest(bucketName, documentName, documentVersion, principalIAM
         if documentVersion:
             lineageItem['versionId'] = documentVersion
         lineage_client.recordLineage(lineageItem)
+        if es:
+            response = es.delete_document(esIndex, documentName=documentName, version=documentVersion)
+            if not response.get('deleted', 0):
+                print("WARNING: no indexed pages matched {} version {}".format(documentName, documentVersion))
         output = "Marked document {}/{} with version {} for deletion".format(bucketName, documentName, documentVersion)
     except Exception as e:
         print(e)
         raise(e)
     print(output)
 
+@flushesMetadata
 def lambda_handler(event, context):
 
     print("event: {}".format(event))
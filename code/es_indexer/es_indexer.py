@@ -0,0 +1,33 @@
+import os
+import json
+from es import ESCluster
+from esbuffer import ESIndexBuffer
+
+esCluster = os.environ.get('TARGET_ES_CLUSTER', None)
+esIndex   = os.environ.get('ES_CLUSTER_INDEX', "document")
+
+if not esCluster:
+    raise Exception("Missing arguments.")
+
+es = ESCluster(host=esCluster)
+
+def lambda_handler(event, context):
+    # Records arrive in batches collected by the SQS event source's batching
+    # window; failed records are reported back so only they are redelivered
+    records = event.get('Records', [])
+    print("Indexing {} queued document(s)".format(len(records)))
+    buffer = ESIndexBuffer(es, esIndex)
+    failed = []
+    for record in records:
+        try:
+            buffer.add(record['body'], record['messageId'])
+        except (ValueError, KeyError) as e:
+            print("Malformed indexing message {}: {}".format(record['messageId'], e))
+            failed.append(record['messageId'])
+            continue
+        if buffer.isFull():
+            failed.extend(buffer.flush()[1])
+    failed.extend(buffer.flush()[1])
+    return {
+        "batchItemFailures": [{"itemIdentifier": messageId} for messageId in failed]
+    }
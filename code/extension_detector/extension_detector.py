@@ -1,7 +1,7 @@
 import json
 import os
 from helper import FileHelper, AwsHelper, S3Helper
-from metadata import DocumentLineageClient, PipelineOperationsClient
+from metadata import DocumentLineageClient, PipelineOperationsClient, flushesMetadata
 
 PIPELINE_STAGE = "EXTENSION_DETECTOR"
 
@@ -37,10 +37,12 @@ def processRequest(documentId, bucketName, objectName, callerId):
     else:
         raise Exception("Incorrect file extension")
     targetFileName = "{}/{}".format(documentId, objectName)  
+    # Set by the registrar on uploads to a versioned bucket
+    sourceVersionId = S3Helper().getTagsS3(bucketName, objectName).get('documentVersion', None)
     if(targetBucketName):
         print("Doing S3 Object Copy for documentId: {}, object: {}/{}".format(documentId, targetBucketName, targetFileName))
         try:
-            S3Helper().copyToS3(bucketName, objectName, targetBucketName, targetFileName)
+            S3Helper().copyToS3(bucketName, objectName, targetBucketName, targetFileName, sourceVersionId=sourceVersionId)
         except Exception as e:
            print(e)
            pipeline_client.stageFailed()
@@ -49,14 +51,17 @@ def processRequest(documentId, bucketName, objectName, callerId):
         pipeline_client.stageFailed()
 
     output = "Completed S3 Object Copy for documentId: {}, object: {}/{}".format(documentId, targetBucketName, targetFileName)
-    lineage_client.recordLineageOfCopy({
+    lineageItem = {
         "documentId":       documentId,
         "callerId":         callerId,
         "sourceBucketName": bucketName,
         "targetBucketName": targetBucketName,
         "sourceFileName":   objectName,
         "targetFileName":   targetFileName,
-    })
+    }
+    if sourceVersionId:
+        lineageItem['sourceVersionId'] = sourceVersionId
+    lineage_client.recordLineageOfCopy(lineageItem)
     pipeline_client.stageSucceeded()
     print(output)
 
@@ -80,6 +85,7 @@ def processRecord(record, syncBucketName, asyncBucketName, callerId):
     if(documentId and bucketName and objectName):
         processRequest(documentId, bucketName, objectName, callerId)
 
+@flushesMetadata
 def lambda_handler(event, context):
     callerId = context.invoked_function_arn
     print(callerId)
@@ -1,18 +1,86 @@
+import os
+import time
+import json
+import base64
+import hashlib
+import threading
 import boto3
-from boto3.dynamodb.conditions import Key
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key, Attr, ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
 from botocore.exceptions import ClientError
 from helper import AwsHelper
-from datetime import datetime
+
+# DynamoDB limits: 25 puts per BatchWriteItem, 25 actions per transaction
+BATCH_WRITE_SIZE    = 25
+TRANSACT_WRITE_SIZE = 25
+MAX_BATCH_RETRIES   = 5
+
+# Documents in these statuses are kept in the ops table's sparse status
+# index; anything else (i.e. SUCCEEDED) drops out of it
+INDEXED_STATUSES    = set(os.environ.get('PIPELINE_INDEXED_STATUSES', 'IN_PROGRESS,FAILED').split(','))
+# Index partitions are spread over this many shards per status. Changing it
+# requires rewriting the index attributes of every indexed document.
+STATUS_INDEX_SHARDS = int(os.environ.get('PIPELINE_STATUS_INDEX_SHARDS', 8))
+INDEX_QUERY_THREADS = 8
+
+class ClientTable:
+    # Query and scan with the same Python-typed arguments and items as a
+    # Table resource, but through the low-level client. Clients (unlike
+    # resources) are thread-safe, so one instance can be shared by the
+    # worker threads of a parallel query.
+    def __init__(self, tableName):
+        self._tableName = tableName
+        self._client = AwsHelper().getClient("dynamodb")
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    def _request(self, args):
+        request = dict(args)
+        request['TableName'] = self._tableName
+        names = dict(request.pop('ExpressionAttributeNames', {}))
+        values = {}
+        builder = ConditionExpressionBuilder()
+        for argName, isKeyCondition in [('KeyConditionExpression', True), ('FilterExpression', False)]:
+            if argName in request and not isinstance(request[argName], str):
+                expression = builder.build_expression(request[argName], is_key_condition=isKeyCondition)
+                request[argName] = expression.condition_expression
+                names.update(expression.attribute_name_placeholders)
+                values.update(expression.attribute_value_placeholders)
+        if names:
+            request['ExpressionAttributeNames'] = names
+        if values:
+            request['ExpressionAttributeValues'] = {name: self._serializer.serialize(value) for name, value in values.items()}
+        if 'ExclusiveStartKey' in request:
+            request['ExclusiveStartKey'] = self._serializeItem(request['ExclusiveStartKey'])
+        return request
+
+    def _serializeItem(self, item):
+        return {name: self._serializer.serialize(value) for name, value in item.items()}
+
+    def _response(self, response):
+        result = {'Items': [self._deserializeItem(item) for item in response.get('Items', [])]}
+        if 'LastEvaluatedKey' in response:
+            result['LastEvaluatedKey'] = self._deserializeItem(response['LastEvaluatedKey'])
+        return result
+
+    def _deserializeItem(self, item):
+        return {name: self._deserializer.deserialize(value) for name, value in item.items()}
+
+    def query(self, **args):
+        return self._response(self._client.query(**self._request(args)))
+
+    def scan(self, **args):
+        return self._response(self._client.scan(**self._request(args)))
 
 class DocumentRegistryStore:
     def __init__(self, documentRegistryName):
         self._registryTableName = documentRegistryName
+        self._table = AwsHelper().getResource("dynamodb").Table(documentRegistryName)
     
-    def registerDocument(self, documentId, bucketName, documentName, documentLink, principalIAMWriter, timestamp, documentMetadata, documentVersion=None):
-        ret = None
-        
-        dynamodb = AwsHelper().getResource("dynamodb")
-        table = dynamodb.Table(self._registryTableName)
+    @staticmethod
+    def _registryItem(documentId, bucketName, documentName, documentLink, principalIAMWriter, timestamp, documentMetadata, documentVersion=None):
         item = {
             "documentId": documentId,
             "principalIAMWriter": principalIAMWriter,
@@ -24,8 +92,14 @@ class DocumentRegistryStore:
         }
         if documentVersion:
             item['documentVersion'] = documentVersion
+        return item
+
+    def registerDocument(self, documentId, bucketName, documentName, documentLink, principalIAMWriter, timestamp, documentMetadata, documentVersion=None):
+        ret = None
+        
+        item = DocumentRegistryStore._registryItem(documentId, bucketName, documentName, documentLink, principalIAMWriter, timestamp, documentMetadata, documentVersion)
         try:
-            table.put_item(
+            self._table.put_item(
                 ConditionExpression = "attribute_not_exists(documentId)",
                 Item = item
             )
@@ -45,20 +119,125 @@ class DocumentRegistryStore:
                 'Status': 400
             }
         return ret
+
+    def registerDocuments(self, documentPayloads):
+        # Registers a batch with conditional puts grouped into transactions.
+        # A cancelled transaction fails only the items whose condition failed
+        # and is retried with the rest. Returns one result per payload.
+        items = [DocumentRegistryStore._registryItem(**payload) for payload in documentPayloads]
+        results = [None] * len(items)
+        pending = []
+        seen = set()
+        for index, item in enumerate(items):
+            # A transaction cannot touch the same item twice
+            if item['documentId'] in seen:
+                results[index] = {
+                    'Error': 'Document {} is already registered in this batch'.format(item['documentId']),
+                    'Status': 400
+                }
+            else:
+                seen.add(item['documentId'])
+                pending.append(index)
+
+        client = AwsHelper().getClient("dynamodb")
+        serializer = TypeSerializer()
+        for start in range(0, len(pending), TRANSACT_WRITE_SIZE):
+            chunk = pending[start:start + TRANSACT_WRITE_SIZE]
+            while chunk:
+                try:
+                    client.transact_write_items(
+                        TransactItems = [{
+                            'Put': {
+                                'TableName': self._registryTableName,
+                                'Item': {key: serializer.serialize(value) for key, value in items[index].items()},
+                                'ConditionExpression': "attribute_not_exists(documentId)"
+                            }
+                        } for index in chunk]
+                    )
+                    for index in chunk:
+                        results[index] = {
+                            'Status': 200
+                        }
+                    chunk = []
+                except ClientError as e:
+                    print(e)
+                    reasons = e.response.get('CancellationReasons')
+                    retry = []
+                    for position, index in enumerate(chunk):
+                        code = reasons[position].get('Code', 'None') if reasons else None
+                        if code == 'None':
+                            retry.append(index)
+                        else:
+                            results[index] = {
+                                'Error': reasons[position].get('Message', code) if reasons else e.response['Error']['Message'],
+                                'Status': e.response['ResponseMetadata']['HTTPStatusCode']
+                            }
+                    if len(retry) == len(chunk):
+                        for index in retry:
+                            results[index] = {
+                                'Error': e.response['Error']['Message'],
+                                'Status': e.response['ResponseMetadata']['HTTPStatusCode']
+                            }
+                        retry = []
+                    chunk = retry
+                except Exception as e:
+                    print(e)
+                    for index in chunk:
+                        results[index] = {
+                            'Error': 'Unknown error occurred during updating document',
+                            'Status': 400
+                        }
+                    chunk = []
+        return results
     
 class LineageStore:
-    def __init__(self, lineageTableName, lineageIndexName):
+    # Per-container memo of signature -> documentId. Only found documentIds
+    # are kept: the oldest row of a signature does not change, while a
+    # missing one may still be written.
+    _memo = OrderedDict()
+    _memoLock = threading.Lock()
+    MEMO_SIZE = 1024
+
+    # Attributes read when walking the lineage graph; timestamp is reserved
+    GRAPH_PROJECTION = "documentId, #ts, documentSignature, sourceSignature, callerId, s3Event, sourceBucketName, sourceFileName, sourceVersionId"
+    GRAPH_MAX_NODES  = 5000
+    GRAPH_THREADS    = 8
+
+    def __init__(self, lineageTableName, lineageIndexName, sourceIndexName="SourceSignatureIndex"):
         self._lineageTableName = lineageTableName
         self._lineageIndexName = lineageIndexName
-    
-    def createLineage(self, documentId, callerId, targetBucketName, targetFileName, timestamp, s3Event, sourceBucketName=None, sourceFileName=None, versionId=None):
-        ret = None
-        
-        dynamodb = AwsHelper().getResource("dynamodb")
-        table = dynamodb.Table(self._lineageTableName)
-        documentSignature = "BUCKET:{}@FILE:{}".format(targetBucketName, targetFileName)
+        self._sourceIndexName = sourceIndexName
+        self._dynamodb = AwsHelper().getResource("dynamodb")
+        self._table = self._dynamodb.Table(lineageTableName)
+        # For the index queries of a graph walk, which run on worker threads
+        self._clientTable = ClientTable(lineageTableName)
+
+    @staticmethod
+    def _memoGet(documentSignature):
+        with LineageStore._memoLock:
+            documentId = LineageStore._memo.get(documentSignature)
+            if documentId:
+                LineageStore._memo.move_to_end(documentSignature)
+            return documentId
+
+    @staticmethod
+    def _memoPut(documentSignature, documentId):
+        with LineageStore._memoLock:
+            LineageStore._memo[documentSignature] = documentId
+            LineageStore._memo.move_to_end(documentSignature)
+            while len(LineageStore._memo) > LineageStore.MEMO_SIZE:
+                LineageStore._memo.popitem(last=False)
+
+    @staticmethod
+    def _documentSignature(bucketName, fileName, versionId=None):
+        documentSignature = "BUCKET:{}@FILE:{}".format(bucketName, fileName)
         if versionId:
             documentSignature += "@VERSION:{}".format(versionId)
+        return documentSignature
+
+    @staticmethod
+    def _lineageItem(documentId, callerId, targetBucketName, targetFileName, timestamp, s3Event, sourceBucketName=None, sourceFileName=None, versionId=None, sourceVersionId=None):
+        documentSignature = LineageStore._documentSignature(targetBucketName, targetFileName, versionId)
         item = {
             "documentId": documentId,
             "documentSignature": documentSignature,
@@ -74,8 +253,21 @@ class LineageStore:
             item['sourceFileName'] = sourceFileName
         if sourceBucketName:
             item['sourceBucketName'] = sourceBucketName
+        if sourceVersionId:
+            item['sourceVersionId'] = sourceVersionId
+        if sourceBucketName and sourceFileName:
+            # Key of the sparse source index, for walking lineage downstream.
+            # Built like documentSignature, so a copy of a versioned upload
+            # points at the upload's own signature.
+            item['sourceSignature'] = LineageStore._documentSignature(sourceBucketName, sourceFileName, sourceVersionId)
+        return item
+    
+    def createLineage(self, documentId, callerId, targetBucketName, targetFileName, timestamp, s3Event, sourceBucketName=None, sourceFileName=None, versionId=None, sourceVersionId=None):
+        ret = None
+        
+        item = LineageStore._lineageItem(documentId, callerId, targetBucketName, targetFileName, timestamp, s3Event, sourceBucketName, sourceFileName, versionId, sourceVersionId)
         try:
-            table.put_item(
+            self._table.put_item(
                 Item = item
             )
             ret = {
@@ -94,21 +286,91 @@ class LineageStore:
                 'Status': 400
             }
         return ret
+
+    def createLineages(self, lineagePayloads):
+        # Writes a batch through BatchWriteItem, retrying unprocessed items
+        # with backoff. Returns one result per payload.
+        items = [LineageStore._lineageItem(**payload) for payload in lineagePayloads]
+        results = [{'Status': 200} for item in items]
+        # Items sharing a key are written once (the last one wins, as with
+        # sequential puts); a batch may not contain the same key twice
+        byKey = {}
+        for index, item in enumerate(items):
+            byKey.setdefault((item['documentId'], item['timestamp']), []).append(index)
+        keys = list(byKey.keys())
+
+        for start in range(0, len(keys), BATCH_WRITE_SIZE):
+            chunk = keys[start:start + BATCH_WRITE_SIZE]
+            request = {
+                self._lineageTableName: [{'PutRequest': {'Item': items[byKey[key][-1]]}} for key in chunk]
+            }
+            attempt = 0
+            try:
+                while request and attempt < MAX_BATCH_RETRIES:
+                    response = self._dynamodb.batch_write_item(RequestItems=request)
+                    request = response.get('UnprocessedItems')
+                    attempt = attempt + 1
+                    if request:
+                        time.sleep(0.05 * (2 ** attempt))
+                failed = []
+                if request:
+                    failed = [(put['PutRequest']['Item']['documentId'], put['PutRequest']['Item']['timestamp'])
+                              for put in request.get(self._lineageTableName, [])]
+                for key in failed:
+                    for index in byKey[key]:
+                        results[index] = {
+                            'Error': 'Lineage item still unprocessed after {} attempts'.format(MAX_BATCH_RETRIES),
+                            'Status': 503
+                        }
+            except ClientError as e:
+                print(e)
+                for key in chunk:
+                    for index in byKey[key]:
+                        results[index] = {
+                            'Error': e.response['Error']['Message'],
+                            'Status': e.response['ResponseMetadata']['HTTPStatusCode']
+                        }
+            except Exception as e:
+                print(e)
+                for key in chunk:
+                    for index in byKey[key]:
+                        results[index] = {
+                            'Error': 'Unknown error occurred during updating document',
+                            'Status': 400
+                        }
+        return results
         
     def queryDocumentId(self, targetBucketName, targetFileName, versionId=None):
+        # The signature index is sorted by timestamp, so the oldest lineage
+        # row (the upload that created the document) is the first item
         ret = None
-        res = None
         
-        dynamodb = AwsHelper().getResource("dynamodb")
-        table = dynamodb.Table(self._lineageTableName)
-        documentSignature = "BUCKET:{}@FILE:{}".format(targetBucketName, targetFileName)
-        if versionId:
-            documentSignature += "@VERSION:{}".format(versionId)
+        documentSignature = LineageStore._documentSignature(targetBucketName, targetFileName, versionId)
+        documentId = LineageStore._memoGet(documentSignature)
+        if documentId:
+            return {
+                'Status': 200,
+                'documentId': documentId
+            }
         try:
-            res = table.query(
+            res = self._table.query(
                 KeyConditionExpression = Key('documentSignature').eq(documentSignature),
-                IndexName = self._lineageIndexName
+                IndexName = self._lineageIndexName,
+                ScanIndexForward = True,
+                Limit = 1
             )
+            items = res.get('Items', [])
+            if len(items) == 0:
+                ret = {
+                    'Status': 404,
+                    'documentId': None
+                }
+            else:
+                LineageStore._memoPut(documentSignature, items[0]['documentId'])
+                ret = {
+                    'Status': 200,
+                    'documentId': items[0]['documentId']
+                }
         except ClientError as e:
             print(e)
             ret = {
@@ -121,39 +383,236 @@ class LineageStore:
                 'Error': 'Unknown error occurred during querying the document Id',
                 'Status': 400
             }
+            
+        return ret
+
+    def _queryKeys(self, indexName, signatureKey, signature):
+        # All (documentId, timestamp) keys of rows matching a signature
+        keys = []
+        args = {
+            'IndexName': indexName,
+            'KeyConditionExpression': Key(signatureKey).eq(signature),
+            'ProjectionExpression': 'documentId, #ts',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'}
+        }
+        while True:
+            response = self._clientTable.query(**args)
+            keys.extend({'documentId': item['documentId'], 'timestamp': item['timestamp']} for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return keys
+
+    def _batchGetRows(self, keys):
+        rows = []
+        for start in range(0, len(keys), 100):
+            request = {
+                self._lineageTableName: {
+                    'Keys': keys[start:start + 100],
+                    'ProjectionExpression': LineageStore.GRAPH_PROJECTION,
+                    'ExpressionAttributeNames': {'#ts': 'timestamp'}
+                }
+            }
+            attempt = 0
+            while request and attempt < MAX_BATCH_RETRIES:
+                response = self._dynamodb.batch_get_item(RequestItems=request)
+                rows.extend(response.get('Responses', {}).get(self._lineageTableName, []))
+                request = response.get('UnprocessedKeys')
+                attempt = attempt + 1
+                if request:
+                    time.sleep(0.05 * (2 ** attempt))
+            if request:
+                raise Exception("Lineage rows still unprocessed after {} attempts".format(MAX_BATCH_RETRIES))
+        return rows
+
+    @staticmethod
+    def _rowSourceSignature(row):
+        # Rows written before sourceSignature existed still carry the source
+        if 'sourceSignature' in row:
+            return row['sourceSignature']
+        if row.get('sourceBucketName') and row.get('sourceFileName'):
+            return LineageStore._documentSignature(row['sourceBucketName'], row['sourceFileName'], row.get('sourceVersionId'))
+        return None
+
+    def _walkGraph(self, seeds, downstream, upstream, maxDepth):
+        # Breadth-first over signatures. Each level queries the signature
+        # indexes for every frontier signature in parallel, then reads the
+        # matching rows with BatchGetItem. Visited signatures and rows are
+        # memoized so that shared ancestors and cycles are expanded once.
+        nodes = set(seeds)
+        edges = {}
+        visited = set()
+        seenRows = set()
+        frontier = list(seeds)
+        depth = 0
+        with ThreadPoolExecutor(max_workers=LineageStore.GRAPH_THREADS) as executor:
+            while frontier and depth < maxDepth and len(nodes) < LineageStore.GRAPH_MAX_NODES:
+                visited.update(frontier)
+                lookups = []
+                for signature in frontier:
+                    if downstream:
+                        lookups.append((self._sourceIndexName, 'sourceSignature', signature))
+                    if upstream:
+                        lookups.append((self._lineageIndexName, 'documentSignature', signature))
+                keys = []
+                for found in executor.map(lambda lookup: self._queryKeys(*lookup), lookups):
+                    for key in found:
+                        rowKey = (key['documentId'], key['timestamp'])
+                        if rowKey not in seenRows:
+                            seenRows.add(rowKey)
+                            keys.append(key)
+
+                nextFrontier = set()
+                for row in self._batchGetRows(keys):
+                    target = row['documentSignature']
+                    source = LineageStore._rowSourceSignature(row)
+                    for signature in (source, target):
+                        if signature and signature not in visited:
+                            nextFrontier.add(signature)
+                        if signature:
+                            nodes.add(signature)
+                    if source:
+                        edges[(row['documentId'], row['timestamp'])] = {
+                            'source':     source,
+                            'target':     target,
+                            'documentId': row['documentId'],
+                            'timestamp':  row['timestamp'],
+                            's3Event':    row.get('s3Event'),
+                            'callerId':   row.get('callerId')
+                        }
+                frontier = list(nextFrontier)
+                depth = depth + 1
+        return {
+            'nodes': sorted(nodes),
+            'edges': sorted(edges.values(), key=lambda edge: edge['timestamp']),
+            'complete': not frontier
+        }
+
+    def getLineageGraph(self, bucketName, fileName, versionId=None, direction="downstream", maxDepth=10):
+        # Every artifact derived from an object (downstream), everything it
+        # was derived from (upstream), or both. Nodes are document
+        # signatures; edges are lineage rows linking a source to a target.
+        ret = None
+        if direction not in ["downstream", "upstream", "both"]:
+            raise ValueError("Unknown lineage direction {}".format(direction))
+        root = LineageStore._documentSignature(bucketName, fileName, versionId)
         try:
-            items = res['Items']
-            print(items)
-            if len(items) == 0:
-                ret = {
+            graph = self._walkGraph([root], direction in ["downstream", "both"], direction in ["upstream", "both"], maxDepth)
+            ret = {
+                'Status': 200,
+                'root': root,
+                **graph
+            }
+        except ClientError as e:
+            print(e)
+            ret = {
+                'Error': e.response['Error']['Message'],
+                'Status': e.response['ResponseMetadata']['HTTPStatusCode']
+            }
+        except Exception as e:
+            print(e)
+            ret = {
+                'Error': 'Unknown error occurred while walking the lineage graph',
+                'Status': 400
+            }
+        return ret
+
+    def getDocumentLineageGraph(self, documentId, maxDepth=10):
+        # The DAG of every copy and derivation of a document: its own rows
+        # seed a walk in both directions
+        ret = None
+        try:
+            seeds = set()
+            args = {
+                'KeyConditionExpression': Key('documentId').eq(documentId),
+                'ProjectionExpression': 'documentSignature'
+            }
+            while True:
+                response = self._table.query(**args)
+                seeds.update(item['documentSignature'] for item in response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            if not seeds:
+                return {
                     'Status': 404,
-                    'documentId': None
-                }
-            else:
-                items.sort(key=lambda item: datetime.fromisoformat(item['timestamp']))
-                ret = {
-                    'Status': 200,
-                    'documentId': items[0]['documentId']
+                    'documentId': documentId
                 }
+            graph = self._walkGraph(sorted(seeds), True, True, maxDepth)
+            ret = {
+                'Status': 200,
+                'documentId': documentId,
+                **graph
+            }
+        except ClientError as e:
+            print(e)
+            ret = {
+                'Error': e.response['Error']['Message'],
+                'Status': e.response['ResponseMetadata']['HTTPStatusCode']
+            }
         except Exception as e:
             print(e)
             ret = {
-                'Error': 'Could not find the documentId for specified document Signature',
+                'Error': 'Unknown error occurred while walking the lineage graph',
                 'Status': 400
             }
-            
         return ret
 
 class PipelineOpsStore:
+    # The ops table holds one small head item per document with its current
+    # status; every status change is a separate item in the events table
+    # (documentId, eventKey), so an update costs the same however long the
+    # document's history is.
+
+    # Documents in an indexed status also carry the keys of a sparse index,
+    # partitioned over STATUS_INDEX_SHARDS shards per status to avoid hot
+    # partitions: statusShard "{status}#{shard}", stageUpdate "{stage}#{lastUpdate}".
+    # A second sparse index keys the same partitions on lastUpdate alone.
+    PROJECTED_ATTRIBUTES = ['documentId', 'bucketName', 'objectName', 'documentStatus', 'documentStage', 'lastUpdate']
 
-    def __init__(self, opsTableName):
+    def __init__(self, opsTableName, eventsTableName, statusIndexName="DocumentStatusIndex", updateIndexName="DocumentUpdateIndex"):
         self._opsTableName = opsTableName
+        self._eventsTableName = eventsTableName
+        self._statusIndexName = statusIndexName
+        self._updateIndexName = updateIndexName
+        dynamodb = AwsHelper().getResource("dynamodb")
+        self._table = dynamodb.Table(opsTableName)
+        self._eventsTable = dynamodb.Table(eventsTableName)
+        # For queries and scans spread over worker threads
+        self._clientTable = ClientTable(opsTableName)
+
+    @staticmethod
+    def _shard(documentId):
+        # Stable across containers, unlike hash()
+        return int(hashlib.md5(documentId.encode('utf-8')).hexdigest(), 16) % STATUS_INDEX_SHARDS
+
+    @staticmethod
+    def _indexAttributes(documentId, status, stage, timestamp):
+        if status not in INDEXED_STATUSES:
+            return {}
+        shard = PipelineOpsStore._shard(documentId)
+        return {
+            "statusShard": "{}#{}".format(status, shard),
+            "stageUpdate": "{}#{}".format(stage, timestamp)
+        }
+
+    @staticmethod
+    def _timelineEvent(documentId, status, stage, timestamp, message=None):
+        event = {
+            "documentId": documentId,
+            # Sorts by time; stage and status keep same-timestamp events apart
+            "eventKey": "{}#{}#{}".format(timestamp, stage, status),
+            "timestamp": timestamp,
+            "stage": stage,
+            "status": status
+        }
+        if message:
+            event['message'] = message
+        return event
 
     def startDocumentTracking(self, documentId, bucketName, objectName, status, stage, timestamp, versionId=None):
 
         ret = None
-        dynamodb = AwsHelper().getResource("dynamodb")
-        table = dynamodb.Table(self._opsTableName)
         item = {
             "documentId": documentId,
             "bucketName": bucketName,
@@ -161,19 +620,18 @@ class PipelineOpsStore:
             "documentStatus": status,
             "documentStage": stage,
             "lastUpdate": timestamp,
-            "timeline": [{
-                "timestamp": timestamp,
-                "stage": stage,
-                "status": status
-            }]
+            **PipelineOpsStore._indexAttributes(documentId, status, stage, timestamp)
         }
         if versionId:
             item['documentVersion'] = versionId
         try:
-            table.put_item(
+            self._table.put_item(
                 ConditionExpression = "attribute_not_exists(documentId)",
                 Item = item
             )
+            self._eventsTable.put_item(
+                Item = PipelineOpsStore._timelineEvent(documentId, status, stage, timestamp)
+            )
             ret = {
                 'Status': 200
             }
@@ -195,34 +653,29 @@ class PipelineOpsStore:
 
         ret = None
 
-        dynamodb = AwsHelper().getResource("dynamodb")
-        table = dynamodb.Table(self._opsTableName)
         try:
-            if message:
-                new_datapoint = {
-                    "timestamp": timestamp,
-                    "stage": stage,
-                    "status": status,
-                    "message": message
-                }
+            indexAttributes = PipelineOpsStore._indexAttributes(documentId, status, stage, timestamp)
+            updateExpression = 'SET documentStatus = :documentStatus, documentStage = :documentStage, lastUpdate = :lastUpdate'
+            values = {
+                ':documentStatus': status,
+                ':documentStage': stage,
+                ':lastUpdate': timestamp
+            }
+            if indexAttributes:
+                updateExpression += ', statusShard = :statusShard, stageUpdate = :stageUpdate'
+                values.update({':' + name: value for name, value in indexAttributes.items()})
             else:
-                new_datapoint = {
-                    "timestamp": timestamp,
-                    "stage": stage,
-                    "status": status
-                }
-            table.update_item(
+                updateExpression += ' REMOVE statusShard, stageUpdate'
+            self._table.update_item(
                 Key = {
                     'documentId': documentId
                 },
-                UpdateExpression = 'SET documentStatus = :documentStatus, documentStage = :documentStage, lastUpdate = :lastUpdate, timeline = list_append(timeline, :new_datapoint)',
+                UpdateExpression = updateExpression,
                 ConditionExpression = 'attribute_exists(documentId)',
-                ExpressionAttributeValues = {
-                    ':documentStatus': status,
-                    ':documentStage': stage,
-                    ':lastUpdate': timestamp,
-                    ':new_datapoint': [new_datapoint]
-                }
+                ExpressionAttributeValues = values
+            )
+            self._eventsTable.put_item(
+                Item = PipelineOpsStore._timelineEvent(documentId, status, stage, timestamp, message)
             )
             ret = {
                 'Status': 200
@@ -266,17 +719,72 @@ class PipelineOpsStore:
 
         return itemToReturn
 
-    def deleteDocument(self, documentId):
+    def getDocumentTimeline(self, documentId, limit=None, nextToken=None):
+        # Returns the document's events oldest first. Without a limit the
+        # whole timeline is read; with one, a page of up to limit event
+        # items plus a nextToken.
+        events = []
+        fetched = 0
+        args = {
+            'KeyConditionExpression': Key('documentId').eq(documentId),
+            'ScanIndexForward': True
+        }
+        if nextToken:
+            args['ExclusiveStartKey'] = {'documentId': documentId, 'eventKey': nextToken}
+        else:
+            # Head items written before the events table kept the timeline inline
+            head = self._table.get_item(
+                Key = {'documentId': documentId},
+                ProjectionExpression = 'timeline'
+            ).get('Item', {})
+            events.extend(head.get('timeline', []))
+        while True:
+            if limit:
+                args['Limit'] = limit - fetched
+            response = self._eventsTable.query(**args)
+            fetched = fetched + len(response.get('Items', []))
+            for item in response.get('Items', []):
+                event = {
+                    "timestamp": item['timestamp'],
+                    "stage": item['stage'],
+                    "status": item['status']
+                }
+                if 'message' in item:
+                    event['message'] = item['message']
+                events.append(event)
+            lastKey = response.get('LastEvaluatedKey')
+            if not lastKey or (limit and fetched >= limit):
+                break
+            args['ExclusiveStartKey'] = lastKey
+        timeline = {
+            "documentId": documentId,
+            "timeline": events
+        }
+        if limit and lastKey:
+            timeline["nextToken"] = lastKey['eventKey']
+        return timeline
 
-        dynamodb = AwsHelper().getResource("dynamodb")
-        table = dynamodb.Table(self._opsTableName)
+    def deleteDocument(self, documentId):
 
-        table.delete_item(
+        self._table.delete_item(
             Key={
                 'documentId': documentId
             }
         )
 
+        args = {
+            'KeyConditionExpression': Key('documentId').eq(documentId),
+            'ProjectionExpression': 'documentId, eventKey'
+        }
+        with self._eventsTable.batch_writer() as batch:
+            while True:
+                response = self._eventsTable.query(**args)
+                for item in response.get('Items', []):
+                    batch.delete_item(Key={'documentId': item['documentId'], 'eventKey': item['eventKey']})
+                if 'LastEvaluatedKey' not in response:
+                    break
+                args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
     def getDocuments(self, nextToken=None):
 
         dynamodb = AwsHelper().getResource("dynamodb")
@@ -305,4 +813,132 @@ class PipelineOpsStore:
             print("nexToken: {}".format(nextToken))
             documents["nextToken"] = nextToken
 
-        return documents
\ No newline at end of file
+        return documents
+
+    @staticmethod
+    def _projectDocument(item):
+        return {
+            'documentId' : item['documentId'],
+            'bucketName' : item.get('bucketName'),
+            'objectName' : item.get('objectName'),
+            'status'     : item.get('documentStatus'),
+            'stage'      : item.get('documentStage'),
+            'lastUpdate' : item.get('lastUpdate')
+        }
+
+    def _queryShards(self, indexName, sortKeyName, partitions, sortCondition, limit, nextToken, ascending):
+        # Queries the index partitions in parallel and merges the results by
+        # the index sort key. nextToken holds a start key per partition;
+        # a partition only advances past the items actually returned.
+        cursors = json.loads(base64.urlsafe_b64decode(nextToken.encode('utf-8')).decode('utf-8')) if nextToken else {}
+        if nextToken:
+            partitions = [partition for partition in partitions if partition in cursors]
+
+        def queryPartition(partition):
+            keyCondition = Key('statusShard').eq(partition)
+            if sortCondition:
+                keyCondition = keyCondition & sortCondition
+            args = {
+                'IndexName': indexName,
+                'KeyConditionExpression': keyCondition,
+                'ProjectionExpression': ', '.join(sorted(set(PipelineOpsStore.PROJECTED_ATTRIBUTES + ['statusShard', sortKeyName]))),
+                'ScanIndexForward': ascending,
+                'Limit': limit
+            }
+            if cursors.get(partition):
+                args['ExclusiveStartKey'] = cursors[partition]
+            response = self._clientTable.query(**args)
+            return partition, response.get('Items', []), response.get('LastEvaluatedKey')
+
+        with ThreadPoolExecutor(max_workers=min(INDEX_QUERY_THREADS, max(len(partitions), 1))) as executor:
+            results = list(executor.map(queryPartition, partitions))
+
+        merged = [(item[sortKeyName], partition, item) for partition, items, lastKey in results for item in items]
+        merged.sort(key=lambda entry: entry[0], reverse=not ascending)
+        page = merged[:limit]
+
+        nextCursors = {}
+        for partition, items, lastKey in results:
+            returned = [item for sortValue, itemPartition, item in page if itemPartition == partition]
+            if len(returned) < len(items):
+                last = returned[-1] if returned else None
+                nextCursors[partition] = {
+                    'documentId':  last['documentId'],
+                    'statusShard': partition,
+                    sortKeyName:   last[sortKeyName]
+                } if last else cursors.get(partition)
+            elif lastKey:
+                nextCursors[partition] = lastKey
+        documents = {
+            "documents": [PipelineOpsStore._projectDocument(item) for sortValue, partition, item in page]
+        }
+        if nextCursors:
+            documents["nextToken"] = base64.urlsafe_b64encode(json.dumps(nextCursors).encode('utf-8')).decode('utf-8')
+        return documents
+
+    @staticmethod
+    def _stageCondition(stage, updatedAfter=None, updatedBefore=None):
+        if updatedAfter or updatedBefore:
+            return Key('stageUpdate').between(
+                "{}#{}".format(stage, updatedAfter or ""),
+                "{}#{}".format(stage, updatedBefore or "\uffff"))
+        return Key('stageUpdate').begins_with("{}#".format(stage))
+
+    @staticmethod
+    def _statusPartitions(statuses):
+        for status in statuses:
+            if status not in INDEXED_STATUSES:
+                raise ValueError("Status {} is not indexed; use scanDocuments instead".format(status))
+        return ["{}#{}".format(status, shard) for status in sorted(statuses) for shard in range(STATUS_INDEX_SHARDS)]
+
+    def queryDocumentsByStatus(self, status, stage=None, updatedAfter=None, updatedBefore=None, limit=25, nextToken=None, ascending=True):
+        # Documents in an indexed status, optionally narrowed to one stage
+        # and a lastUpdate range, e.g. IN_PROGRESS in ASYNC_PROCESS_TEXTRACT
+        # for more than an hour
+        if stage:
+            return self._queryShards(self._statusIndexName, 'stageUpdate', PipelineOpsStore._statusPartitions([status]),
+                PipelineOpsStore._stageCondition(stage, updatedAfter, updatedBefore), limit, nextToken, ascending)
+        return self.queryDocumentsByLastUpdate(updatedAfter, updatedBefore, [status], limit, nextToken, ascending)
+
+    def queryDocumentsByStage(self, stage, statuses=None, updatedAfter=None, updatedBefore=None, limit=25, nextToken=None, ascending=True):
+        # Documents currently in a stage, across the indexed statuses
+        return self._queryShards(self._statusIndexName, 'stageUpdate', PipelineOpsStore._statusPartitions(statuses or INDEXED_STATUSES),
+            PipelineOpsStore._stageCondition(stage, updatedAfter, updatedBefore), limit, nextToken, ascending)
+
+    def queryDocumentsByLastUpdate(self, updatedAfter=None, updatedBefore=None, statuses=None, limit=25, nextToken=None, ascending=True):
+        # Indexed documents whose lastUpdate falls in the range, across all
+        # stages, ordered by lastUpdate. The range is a key condition on the
+        # update index, so only matching documents are read.
+        sortCondition = None
+        if updatedAfter and updatedBefore:
+            sortCondition = Key('lastUpdate').between(updatedAfter, updatedBefore)
+        elif updatedAfter:
+            sortCondition = Key('lastUpdate').gte(updatedAfter)
+        elif updatedBefore:
+            sortCondition = Key('lastUpdate').lte(updatedBefore)
+        return self._queryShards(self._updateIndexName, 'lastUpdate', PipelineOpsStore._statusPartitions(statuses or INDEXED_STATUSES),
+            sortCondition, limit, nextToken, ascending)
+
+    def scanDocuments(self, totalSegments=8, status=None):
+        # Full export through a parallel segmented scan, for statuses the
+        # sparse indexes leave out
+        def scanSegment(segment):
+            items = []
+            args = {
+                'Segment': segment,
+                'TotalSegments': totalSegments,
+                'ProjectionExpression': ', '.join(PipelineOpsStore.PROJECTED_ATTRIBUTES)
+            }
+            if status:
+                args['FilterExpression'] = Attr('documentStatus').eq(status)
+            while True:
+                response = self._clientTable.scan(**args)
+                items.extend(response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            return items
+
+        with ThreadPoolExecutor(max_workers=totalSegments) as executor:
+            segments = list(executor.map(scanSegment, range(totalSegments)))
+        return [PipelineOpsStore._projectDocument(item) for items in segments for item in items]
@@ -3,53 +3,157 @@ from botocore.client import Config
 import os
 import csv
 import io
+import threading
 from boto3.dynamodb.conditions import Key
 from boto3.dynamodb.types import TypeDeserializer
 
 class SQSHelper:
-    
+    # Queue URLs are derived from the ARN once per container instead of
+    # calling get_queue_url for every message
+    _queueUrls = {}
+
+    @staticmethod
+    def getQueueUrl(queueArn):
+        if queueArn not in SQSHelper._queueUrls:
+            queueParts = queueArn.split(":")
+            partition, region, queueAccount, queueName = queueParts[1], queueParts[3], queueParts[4], queueParts[5]
+            domain = "amazonaws.com.cn" if partition == "aws-cn" else "amazonaws.com"
+            SQSHelper._queueUrls[queueArn] = "https://sqs.{}.{}/{}/{}".format(region, domain, queueAccount, queueName)
+        return SQSHelper._queueUrls[queueArn]
+
     @staticmethod
     def deleteMessage(queueArn, receipt):
         sqs = AwsHelper().getClient("sqs")
-    
-        queueParts = queueArn.split(":")
-        queueName = queueParts[-1]
-        queueAccount = queueParts[-2]
-        print(queueName)
-        print(queueAccount)
-        try:
-            queueUrl = sqs.get_queue_url(
-                QueueName              = queueName,
-                QueueOwnerAWSAccountId = queueAccount
-            )['QueueUrl']
-            
-            sqs.delete_message(
-                QueueUrl      = queueUrl,
-                ReceiptHandle = receipt
+        sqs.delete_message(
+            QueueUrl      = SQSHelper.getQueueUrl(queueArn),
+            ReceiptHandle = receipt
+        )
+
+    @staticmethod
+    def deleteMessages(queueArn, receipts):
+        # Deletes in batches of 10; returns the receipts that failed
+        sqs = AwsHelper().getClient("sqs")
+        queueUrl = SQSHelper.getQueueUrl(queueArn)
+        receipts = list(receipts)
+        failed = []
+        for start in range(0, len(receipts), 10):
+            batch = receipts[start:start + 10]
+            response = sqs.delete_message_batch(
+                QueueUrl = queueUrl,
+                Entries  = [{'Id': str(i), 'ReceiptHandle': receipt} for i, receipt in enumerate(batch)]
             )
-        except Exception as e:
-            raise(e)
+            for failure in response.get('Failed', []):
+                print("Could not delete message: {}".format(failure.get('Message')))
+                failed.append(batch[int(failure['Id'])])
+        return failed
+
+    @staticmethod
+    def processBatch(records, processRecord):
+        # Runs processRecord on every record and returns the partial batch
+        # response, so the event source deletes the successful messages.
+        # On FIFO queues, messages behind a failure in the same message
+        # group are failed too so that they are not processed out of order.
+        batchItemFailures = []
+        failedGroups = set()
+        for record in records:
+            messageGroupId = record.get('attributes', {}).get('MessageGroupId')
+            if messageGroupId is not None and messageGroupId in failedGroups:
+                batchItemFailures.append({"itemIdentifier": record['messageId']})
+                continue
+            try:
+                processRecord(record)
+            except Exception as e:
+                print("Failed to process message {}: {}".format(record['messageId'], e))
+                batchItemFailures.append({"itemIdentifier": record['messageId']})
+                if messageGroupId is not None:
+                    failedGroups.add(messageGroupId)
+        return {"batchItemFailures": batchItemFailures}
+
+    @staticmethod
+    def processBatchWrites(records, parseRecord, writeBatch):
+        # Like processBatch, but parseRecord only turns each record into a
+        # payload (or None to skip it) and writeBatch stores all payloads in
+        # one pass, returning one {'Status': ...} result per payload
+        batchItemFailures = []
+        failedGroups = set()
+
+        def fail(record, error):
+            print("Failed to process message {}: {}".format(record['messageId'], error))
+            batchItemFailures.append({"itemIdentifier": record['messageId']})
+            messageGroupId = record.get('attributes', {}).get('MessageGroupId')
+            if messageGroupId is not None:
+                failedGroups.add(messageGroupId)
+
+        parsed = []
+        for record in records:
+            if record.get('attributes', {}).get('MessageGroupId') in failedGroups:
+                fail(record, "an earlier message in its group failed")
+                continue
+            try:
+                payload = parseRecord(record)
+            except Exception as e:
+                fail(record, e)
+                continue
+            if payload is not None:
+                parsed.append((record, payload))
+
+        results = writeBatch([payload for record, payload in parsed]) if parsed else []
+        for (record, payload), result in zip(parsed, results):
+            if result['Status'] != 200:
+                fail(record, result.get('Error'))
+            elif record.get('attributes', {}).get('MessageGroupId') in failedGroups:
+                # Written, but redelivered with the failed message before it
+                fail(record, "an earlier message in its group failed")
+        return {"batchItemFailures": batchItemFailures}
 
 class AwsHelper:
-    def getClient(self, name, awsRegion=None):
-        config = Config(
+    # Clients and resources are cached for the life of the container so warm
+    # invocations (and repeated calls within one) reuse the same connection pool.
+    _cache = {}
+    _cacheLock = threading.Lock()
+    _hits = 0
+    _misses = 0
+
+    @staticmethod
+    def _getConfig():
+        return Config(
             retries = dict(
                 max_attempts = 30
             )
         )
-        if(awsRegion):
-            return boto3.client(name, region_name=awsRegion, config=config)
-        else:
-            return boto3.client(name, config=config)
+
+    def _getCached(self, kind, name, awsRegion, factory):
+        key = (kind, name, awsRegion)
+        with AwsHelper._cacheLock:
+            if key in AwsHelper._cache:
+                AwsHelper._hits += 1
+                return AwsHelper._cache[key]
+            AwsHelper._misses += 1
+            if(awsRegion):
+                obj = factory(name, region_name=awsRegion, config=AwsHelper._getConfig())
+            else:
+                obj = factory(name, config=AwsHelper._getConfig())
+            AwsHelper._cache[key] = obj
+            return obj
+
+    def getClient(self, name, awsRegion=None):
+        return self._getCached("client", name, awsRegion, boto3.client)
 
     def getResource(self, name, awsRegion=None):
-        config = Config(
-            retries = dict(
-                max_attempts = 30
-            )
-        )
+        return self._getCached("resource", name, awsRegion, boto3.resource)
 
-        if(awsRegion):
-            return boto3.resource(name, region_name=awsRegion, config=config)
-        else:
-            return boto3.resource(name, config=config)
+    @staticmethod
+    def getCacheStats():
+        with AwsHelper._cacheLock:
+            return {
+                "hits"   : AwsHelper._hits,
+                "misses" : AwsHelper._misses,
+                "size"   : len(AwsHelper._cache)
+            }
+
+    @staticmethod
+    def clearCache():
+        with AwsHelper._cacheLock:
+            AwsHelper._cache.clear()
+            AwsHelper._hits = 0
+            AwsHelper._misses = 0
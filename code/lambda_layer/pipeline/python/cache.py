@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from helper import AwsHelper
+
+class LRUCacheBackend:
+    # In-process cache; survives across warm invocations of the same container
+    def __init__(self, maxItems=10000):
+        self._maxItems = maxItems
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def getMany(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._items:
+                    self._items.move_to_end(key)
+                    found[key] = self._items[key]
+        return found
+
+    def putMany(self, items):
+        with self._lock:
+            for key, value in items.items():
+                self._items[key] = value
+                self._items.move_to_end(key)
+            while len(self._items) > self._maxItems:
+                self._items.popitem(last=False)
+
+class SQLiteCacheBackend:
+    # Local file cache, e.g. under /tmp in Lambda or for offline testing
+    def __init__(self, path, ttlSeconds=None):
+        self._ttlSeconds = ttlSeconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (cacheKey TEXT PRIMARY KEY, value TEXT, expiresAt REAL)")
+            self._connection.commit()
+
+    def getMany(self, keys):
+        found = {}
+        keys = list(keys)
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._connection.execute(
+                    "SELECT cacheKey, value FROM results WHERE cacheKey IN ({}) AND (expiresAt IS NULL OR expiresAt > ?)".format(
+                        ",".join("?" * len(chunk))),
+                    chunk + [now]
+                )
+                for key, value in rows:
+                    found[key] = value
+        return found
+
+    def putMany(self, items):
+        expiresAt = time.time() + self._ttlSeconds if self._ttlSeconds else None
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results (cacheKey, value, expiresAt) VALUES (?, ?, ?)",
+                [(key, value, expiresAt) for key, value in items.items()]
+            )
+            self._connection.commit()
+
+class DynamoDBCacheBackend:
+    # Shared cache across containers; expired items are removed by the table's
+    # TTL on the expiresAt attribute
+    MAX_RETRIES = 5
+
+    def __init__(self, tableName, ttlSeconds=30 * 24 * 3600, awsRegion=None):
+        self._tableName = tableName
+        self._ttlSeconds = ttlSeconds
+        self._client = AwsHelper().getClient("dynamodb", awsRegion)
+
+    def getMany(self, keys):
+        found = {}
+        keys = list(keys)
+        now = int(time.time())
+        for start in range(0, len(keys), 100):
+            request = {
+                self._tableName: {
+                    'Keys': [{'cacheKey': {'S': key}} for key in keys[start:start + 100]],
+                    'ProjectionExpression': 'cacheKey, #v, expiresAt',
+                    'ExpressionAttributeNames': {'#v': 'value'}
+                }
+            }
+            attempt = 0
+            while request and attempt < DynamoDBCacheBackend.MAX_RETRIES:
+                response = self._client.batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(self._tableName, []):
+                    if 'expiresAt' in item and int(item['expiresAt']['N']) <= now:
+                        continue
+                    found[item['cacheKey']['S']] = item['value']['S']
+                request = response.get('UnprocessedKeys')
+                attempt = attempt + 1
+                if request:
+                    time.sleep(0.05 * (2 ** attempt))
+        return found
+
+    def putMany(self, items):
+        expiresAt = str(int(time.time()) + self._ttlSeconds)
+        requests = [{
+            'PutRequest': {
+                'Item': {
+                    'cacheKey':  {'S': key},
+                    'value':     {'S': value},
+                    'expiresAt': {'N': expiresAt}
+                }
+            }
+        } for key, value in items.items()]
+        for start in range(0, len(requests), 25):
+            request = {self._tableName: requests[start:start + 25]}
+            attempt = 0
+            while request and attempt < DynamoDBCacheBackend.MAX_RETRIES:
+                response = self._client.batch_write_item(RequestItems=request)
+                request = response.get('UnprocessedItems')
+                attempt = attempt + 1
+                if request:
+                    time.sleep(0.05 * (2 ** attempt))
+
+class ComprehendResultCache:
+    # Caches Comprehend results per (api, language, text), keyed on a SHA-256
+    # of the text. Only trailing whitespace is normalized away, so cached
+    # character offsets stay valid for every text sharing a key.
+    def __init__(self, backend):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        # Counts for the life of the container; the above reset on stats(reset=True)
+        self._totalHits = 0
+        self._totalMisses = 0
+
+    @staticmethod
+    def key(api, language, text):
+        digest = hashlib.sha256(text.rstrip().encode('utf-8')).hexdigest()
+        return "{}:{}:{}".format(api, language, digest)
+
+    def getMany(self, api, language, texts):
+        # Returns {index: result} for the texts that are cached
+        keys = [ComprehendResultCache.key(api, language, text) for text in texts]
+        try:
+            found = self._backend.getMany(set(keys))
+        except Exception as e:
+            print("Comprehend cache lookup failed: {}".format(e))
+            found = {}
+        results = {}
+        for index, key in enumerate(keys):
+            if key in found:
+                results[index] = json.loads(found[key])
+        with self._lock:
+            self._hits = self._hits + len(results)
+            self._misses = self._misses + len(keys) - len(results)
+            self._totalHits = self._totalHits + len(results)
+            self._totalMisses = self._totalMisses + len(keys) - len(results)
+        return results
+
+    def putMany(self, api, language, texts, results):
+        items = {}
+        for text, result in zip(texts, results):
+            items[ComprehendResultCache.key(api, language, text)] = json.dumps(result)
+        try:
+            self._backend.putMany(items)
+        except Exception as e:
+            print("Comprehend cache write failed: {}".format(e))
+
+    def stats(self, reset=False):
+        # Hits and misses since the last reset, plus container totals
+        with self._lock:
+            lookups = self._hits + self._misses
+            totalLookups = self._totalHits + self._totalMisses
+            stats = {
+                "hits"            : self._hits,
+                "misses"          : self._misses,
+                "hitRate"         : round(float(self._hits) / lookups, 4) if lookups else 0.0,
+                "containerHits"   : self._totalHits,
+                "containerMisses" : self._totalMisses,
+                "containerHitRate": round(float(self._totalHits) / totalLookups, 4) if totalLookups else 0.0
+            }
+            if reset:
+                self._hits = 0
+                self._misses = 0
+            return stats
+
+def createComprehendCache(backendName=None):
+    # COMPREHEND_CACHE selects the backend: memory (default), sqlite,
+    # dynamodb or none
+    backendName = backendName or os.environ.get('COMPREHEND_CACHE', 'memory')
+    ttlSeconds = int(os.environ.get('COMPREHEND_CACHE_TTL', 30 * 24 * 3600))
+    if backendName == 'none':
+        return None
+    elif backendName == 'memory':
+        backend = LRUCacheBackend(int(os.environ.get('COMPREHEND_CACHE_SIZE', 10000)))
+    elif backendName == 'sqlite':
+        backend = SQLiteCacheBackend(os.environ.get('COMPREHEND_CACHE_PATH', '/tmp/comprehend-cache.db'), ttlSeconds)
+    elif backendName == 'dynamodb':
+        tableName = os.environ.get('COMPREHEND_CACHE_TABLE', None)
+        if not tableName:
+            raise ValueError("COMPREHEND_CACHE_TABLE is required for the dynamodb cache backend")
+        backend = DynamoDBCacheBackend(tableName, ttlSeconds)
+    else:
+        raise ValueError("Unknown Comprehend cache backend {}".format(backendName))
+    return ComprehendResultCache(backend)
@@ -1,15 +1,99 @@
 import os
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse
 import boto3
 from elasticsearch import Elasticsearch, RequestsHttpConnection, helpers
 import requests
 from pprint import pprint
-from requests_aws4auth import AWS4Auth
+from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
 
 # Set by lambda itself
 default_region = os.environ['AWS_REGION']
 
+# Connections are kept at module level so warm invocations reuse the same
+# keep-alive HTTP pool instead of reconnecting for every document.
+HEALTH_CHECK_INTERVAL = int(os.environ.get('ES_HEALTH_CHECK_INTERVAL', 300))
+_connections = {}
+_connectionsLock = threading.Lock()
+
+BULK_CHUNK_SIZE      = int(os.environ.get('ES_BULK_CHUNK_SIZE', 500))
+BULK_MAX_CHUNK_BYTES = int(os.environ.get('ES_BULK_MAX_BYTES', 5 * 1024 * 1024))
+BULK_MAX_RETRIES     = int(os.environ.get('ES_BULK_MAX_RETRIES', 5))
+BULK_THREAD_COUNT    = int(os.environ.get('ES_BULK_THREADS', 1))
+BULK_INITIAL_BACKOFF = 1
+BULK_MAX_BACKOFF     = 30
+
+# index replaces a page document wholesale, upsert merges into it
+WRITE_MODE           = os.environ.get('ES_WRITE_MODE', 'index')
+DEFAULT_DOCUMENT_VERSION = "1"
+
+INDEX_TEMPLATE_NAME  = os.environ.get('ES_INDEX_TEMPLATE', 'document-pages')
+INDEX_SHARDS         = int(os.environ.get('ES_INDEX_SHARDS', 1))
+INDEX_REPLICAS       = int(os.environ.get('ES_INDEX_REPLICAS', 1))
+INDEX_REFRESH        = os.environ.get('ES_INDEX_REFRESH_INTERVAL', '30s')
+# Templates installed by this container, so each is put at most once
+_templates = set()
+
+def pageIndexTemplate(index):
+    # Fixed mapping for page documents. Only text is analyzed; key phrases,
+    # entities and form pairs are keywords, tables and mentions are kept in
+    # _source only, and unknown fields are not mapped at all.
+    lowercaseKeyword = {'type': 'keyword', 'normalizer': 'lowercase_keyword', 'ignore_above': 256}
+    return {
+        'index_patterns': [index, index + '-*'],
+        'settings': {
+            'number_of_shards':   INDEX_SHARDS,
+            'number_of_replicas': INDEX_REPLICAS,
+            'refresh_interval':   INDEX_REFRESH,
+            'analysis': {
+                'normalizer': {
+                    'lowercase_keyword': {'type': 'custom', 'filter': ['lowercase']}
+                }
+            }
+        },
+        'mappings': {
+            'dynamic': False,
+            'properties': {
+                'documentId':   {'type': 'keyword'},
+                'documentName': {'type': 'keyword'},
+                'version':      {'type': 'keyword'},
+                'page':         {'type': 'integer'},
+                'text':       {'type': 'text'},
+                'KeyPhrases': lowercaseKeyword,
+                'Entities': {
+                    'type': 'nested',
+                    'properties': {
+                        'type': {'type': 'keyword'},
+                        'text': lowercaseKeyword
+                    }
+                },
+                'forms': {
+                    'type': 'nested',
+                    'properties': {
+                        'key':   lowercaseKeyword,
+                        'value': lowercaseKeyword
+                    }
+                },
+                'table':    {'type': 'object', 'enabled': False},
+                'Mentions': {'type': 'object', 'enabled': False}
+            }
+        }
+    }
+
+def normalizeEntities(entities):
+    # Accepts a {type: text} dict or (type, text) pairs and returns the
+    # nested [{type, text}] shape the template maps
+    if isinstance(entities, dict):
+        entities = entities.items()
+    return [{'type': entityType, 'text': entityText} for entityType, entityText in sorted(set(entities))]
+
+def normalizeForms(forms):
+    # Form rows from OutputGenerator are [key, value] lists
+    return [{'key': row[0], 'value': row[1]} for row in forms]
+
 class ESCluster:
     def __init__(self, host, use_ssl=True, port=443, verify_certs=True, region=None):
         if default_region:
@@ -20,35 +104,183 @@ class ESCluster:
         self._port = port
         self._verify_certs = verify_certs
         self._use_ssl = use_ssl
-        
+        self._connection = None
+
+    def _connectionKey(self):
+        return (self._host, self._port, self._use_ssl, self._verify_certs, self._region)
+
+    def _isHealthy(self, cached):
+        # Ping at most once per HEALTH_CHECK_INTERVAL seconds. The entry's own
+        # lock is held, not _connectionsLock, so a slow endpoint only holds
+        # up callers of that endpoint.
+        with cached['lock']:
+            if time.time() - cached['checked'] < HEALTH_CHECK_INTERVAL:
+                return cached['healthy']
+            try:
+                healthy = cached['connection'].ping()
+            except Exception as E:
+                print(E)
+                healthy = False
+            cached['checked'] = time.time()
+            cached['healthy'] = healthy
+            return healthy
+
     def connect(self):
-        print ("Connecting to the ES Endpoint {}".format(self._host))
-        credentials = boto3.Session().get_credentials()
-        awsauth = AWS4Auth(
-            credentials.access_key, 
-            credentials.secret_key, 
-            self._region, 'es',
-            session_token=credentials.token)
-        try:
-            self._connection = Elasticsearch(
-                    hosts=[
-                        {'host': self._host, 'port': self._port}
-                    ],
-                    http_auth=awsauth,
-                    use_ssl=self._use_ssl,
-                    verify_certs=self._verify_certs,
-                    connection_class=RequestsHttpConnection)
-            print("Successfully established connection to {}".format(self._host))       
+        key = self._connectionKey()
+        with _connectionsLock:
+            cached = _connections.get(key)
+        if cached and self._isHealthy(cached):
+            self._connection = cached['connection']
             return self._connection
-        except Exception as E:
-            print("Unable to connect to {}".format(self._host))
-            print(E)
-    
+
+        with _connectionsLock:
+            current = _connections.get(key)
+            if current is not None and current is not cached:
+                # another thread already reconnected
+                self._connection = current['connection']
+                return self._connection
+
+            print ("Connecting to the ES Endpoint {}".format(self._host))
+            # Credentials are looked up from the botocore session on every
+            # request, so rotated Lambda role credentials are picked up without
+            # rebuilding the client.
+            awsauth = BotoAWSRequestsAuth(
+                aws_host=self._host,
+                aws_region=self._region,
+                aws_service='es')
+            try:
+                self._connection = Elasticsearch(
+                        hosts=[
+                            {'host': self._host, 'port': self._port}
+                        ],
+                        http_auth=awsauth,
+                        use_ssl=self._use_ssl,
+                        verify_certs=self._verify_certs,
+                        connection_class=RequestsHttpConnection)
+                _connections[key] = {
+                    'connection': self._connection,
+                    'checked': time.time(),
+                    'healthy': True,
+                    'lock': threading.Lock()
+                }
+                print("Successfully established connection to {}".format(self._host))
+            except Exception as E:
+                print("Unable to connect to {}".format(self._host))
+                print(E)
+                return None
+
+        if cached:
+            # Release the pooled sockets of the client that failed its check
+            try:
+                cached['connection'].transport.close()
+            except Exception as E:
+                print(E)
+        return self._connection
+
+    # Every use goes through connect(), so warm containers that keep one
+    # ESCluster at module level are still health-checked and reconnected
+    @property
+    def connection(self):
+        return self.connect()
+
+    def ensureIndexTemplate(self, index, name=None):
+        # Installs the page template once per container. Templates only apply
+        # when an index is created, so an existing index keeps its mapping.
+        name = name or INDEX_TEMPLATE_NAME
+        key = (self._connectionKey(), name, index)
+        if key in _templates:
+            return
+        self.connection.indices.put_template(name=name, body=pageIndexTemplate(index))
+        _templates.add(key)
+        print("Installed index template {} for {}".format(name, index))
+
     def post(self, index, payload, doctype="_doc"):
-        self._connection.index(index=index, doc_type=doctype, body=payload)
-    
-    def post_bulk(self, index, payload, doctype="_doc"):
-        if isinstance(payload, list):
-            helpers.bulk(self._connection, payload, index=index, doc_type=doctype)
+        self.connection.index(index=index, doc_type=doctype, body=payload)
+
+    def post_pages(self, index, documents, writeMode=None, **kwargs):
+        # Bulk indexes page documents under their deterministic _id. The
+        # template goes in first, so a new index never gets dynamic mappings.
+        self.ensureIndexTemplate(index)
+        return self.post_bulk(index=index, payload=pageActions(index, documents, writeMode), **kwargs)
+
+    def delete_document(self, index, documentId=None, documentName=None, version=None):
+        # Removes every page of a document, matched by documentId and/or the
+        # source documentName, optionally limited to one version
+        filters = []
+        if documentId:
+            filters.append({'term': {'documentId': documentId}})
+        if documentName:
+            filters.append({'term': {'documentName': documentName}})
+        if not filters:
+            raise ValueError("delete_document needs a documentId or documentName")
+        if version:
+            filters.append({'term': {'version': version}})
+        response = self.connection.delete_by_query(
+            index=index,
+            body={'query': {'bool': {'filter': filters}}},
+            conflicts='proceed',
+            ignore_unavailable=True
+        )
+        print("Deleted {} page document(s) from {} for {}".format(
+            response.get('deleted', 0), index, documentId or documentName))
+        return response
+
+    def _streamBulk(self, actions, index, doctype, stats):
+        for ok, item in helpers.streaming_bulk(
+                self.connection, actions,
+                index=index, doc_type=doctype,
+                chunk_size=BULK_CHUNK_SIZE,
+                max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+                max_retries=BULK_MAX_RETRIES,
+                initial_backoff=BULK_INITIAL_BACKOFF,
+                max_backoff=BULK_MAX_BACKOFF,
+                raise_on_error=False,
+                raise_on_exception=False):
+            with stats['lock']:
+                if ok:
+                    stats['success'] = stats['success'] + 1
+                else:
+                    stats['failed'] = stats['failed'] + 1
+                    stats['errors'].append(item)
+
+    def post_bulk(self, index, payload, doctype="_doc", threadCount=None, raiseOnError=True):
+        # Streams the payload in requests capped by both document count and
+        # bytes; items rejected with 429 are retried alone with exponential
+        # backoff. threadCount > 1 splits the payload across parallel bulk
+        # workers. Returns per-item success/failure counts and the failed items.
+        if isinstance(payload, (dict, str)) or not hasattr(payload, '__iter__'):
+            raise Exception("Non-iterable payload detected")
+        stats = {'success': 0, 'failed': 0, 'errors': [], 'lock': threading.Lock()}
+        if threadCount is None:
+            threadCount = BULK_THREAD_COUNT
+        if threadCount > 1:
+            payload = list(payload)
+            with ThreadPoolExecutor(max_workers=threadCount) as executor:
+                futures = [executor.submit(self._streamBulk, payload[i::threadCount], index, doctype, stats)
+                           for i in range(threadCount)]
+                for future in futures:
+                    future.result()
         else:
-            raise Exception("Non-iterable payload detected")
\ No newline at end of file
+            self._streamBulk(payload, index, doctype, stats)
+        del stats['lock']
+        print("Bulk indexing to {}: {} succeeded, {} failed".format(index, stats['success'], stats['failed']))
+        if raiseOnError and stats['failed']:
+            raise Exception("{} document(s) failed to index: {}".format(stats['failed'], stats['errors'][:5]))
+        return stats
+
+def documentKey(payload):
+    # Deterministic _id so that re-delivered or re-processed pages overwrite
+    # the existing document instead of adding a duplicate
+    return "{}-{}-{}".format(payload['documentId'], payload.get('version', DEFAULT_DOCUMENT_VERSION), payload['page'])
+
+def pageAction(index, id, document, writeMode=None):
+    writeMode = writeMode or WRITE_MODE
+    if writeMode == 'index':
+        return {'_op_type': 'index', '_index': index, '_id': id, '_source': document}
+    elif writeMode == 'upsert':
+        return {'_op_type': 'update', '_index': index, '_id': id, 'doc': document, 'doc_as_upsert': True}
+    raise ValueError("Unknown ES write mode {}".format(writeMode))
+
+def pageActions(index, documents, writeMode=None):
+    for document in documents:
+        yield pageAction(index, documentKey(document), document, writeMode)
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from helper import AwsHelper
+from es import documentKey, pageAction
+
+ES_BUFFER_MAX_DOCS  = int(os.environ.get('ES_BUFFER_MAX_DOCS', 500))
+ES_BUFFER_MAX_BYTES = int(os.environ.get('ES_BUFFER_MAX_BYTES', 5 * 1024 * 1024))
+ES_BUFFER_MAX_WAIT  = float(os.environ.get('ES_BUFFER_MAX_WAIT', 30))
+
+# SQS limits: 10 entries and 256 KiB per message and per batch call
+SQS_BATCH_SIZE      = 10
+SQS_MAX_BYTES       = 256 * 1024
+
+class InMemoryQueue:
+    # Local stand-in for SQSQueue. Received messages stay in flight until
+    # deleted and become visible again after visibilityTimeout seconds, so
+    # unacknowledged messages are redelivered the same way SQS does it.
+    def __init__(self, visibilityTimeout=30):
+        self._visibilityTimeout = visibilityTimeout
+        self._messages = OrderedDict()
+        self._inFlight = {}
+        self._lock = threading.Lock()
+
+    def send(self, bodies):
+        with self._lock:
+            for body in bodies:
+                self._messages[str(uuid.uuid4())] = {'body': body, 'visibleAt': 0, 'receiveCount': 0}
+        return []
+
+    def receive(self, maxMessages=SQS_BATCH_SIZE, waitSeconds=0):
+        received = []
+        now = time.time()
+        with self._lock:
+            for messageId, message in self._messages.items():
+                if len(received) >= maxMessages:
+                    break
+                if message['visibleAt'] > now:
+                    continue
+                message['visibleAt'] = now + self._visibilityTimeout
+                message['receiveCount'] = message['receiveCount'] + 1
+                receipt = str(uuid.uuid4())
+                self._inFlight[receipt] = messageId
+                received.append({'receipt': receipt, 'body': message['body']})
+        return received
+
+    def delete(self, receipts):
+        with self._lock:
+            for receipt in receipts:
+                messageId = self._inFlight.pop(receipt, None)
+                if messageId:
+                    self._messages.pop(messageId, None)
+
+    def __len__(self):
+        return len(self._messages)
+
+class SQSQueue:
+    def __init__(self, queueUrl, awsRegion=None):
+        self._queueUrl = queueUrl
+        self._client = AwsHelper().getClient('sqs', awsRegion)
+
+    def _sendBatch(self, bodies):
+        entries = [{'Id': str(i), 'MessageBody': body} for i, body in enumerate(bodies)]
+        response = self._client.send_message_batch(QueueUrl=self._queueUrl, Entries=entries)
+        return [bodies[int(failure['Id'])] for failure in response.get('Failed', [])]
+
+    def send(self, bodies):
+        # Packs bodies into batch calls capped by entry count and bytes.
+        # Returns the bodies that could not be sent.
+        failed = []
+        batch = []
+        batchBytes = 0
+        for body in bodies:
+            size = len(body.encode('utf-8'))
+            if size > SQS_MAX_BYTES:
+                failed.append(body)
+                continue
+            if batch and (len(batch) == SQS_BATCH_SIZE or batchBytes + size > SQS_MAX_BYTES):
+                failed.extend(self._sendBatch(batch))
+                batch = []
+                batchBytes = 0
+            batch.append(body)
+            batchBytes = batchBytes + size
+        if batch:
+            failed.extend(self._sendBatch(batch))
+        return failed
+
+    def receive(self, maxMessages=SQS_BATCH_SIZE, waitSeconds=0):
+        response = self._client.receive_message(
+            QueueUrl=self._queueUrl,
+            MaxNumberOfMessages=min(maxMessages, SQS_BATCH_SIZE),
+            WaitTimeSeconds=waitSeconds
+        )
+        return [{'receipt': message['ReceiptHandle'], 'body': message['Body']}
+                for message in response.get('Messages', [])]
+
+    def delete(self, receipts):
+        receipts = list(receipts)
+        for start in range(0, len(receipts), SQS_BATCH_SIZE):
+            entries = [{'Id': str(i), 'ReceiptHandle': receipt}
+                       for i, receipt in enumerate(receipts[start:start + SQS_BATCH_SIZE])]
+            response = self._client.delete_message_batch(QueueUrl=self._queueUrl, Entries=entries)
+            for failure in response.get('Failed', []):
+                print("Could not delete message {}: {}".format(failure['Id'], failure.get('Message')))
+
+def enqueueDocuments(queue, index, documents):
+    # Producer side: one message per page document. Returns the documents
+    # that could not be queued (e.g. over the SQS size limit) so the caller
+    # can index them directly.
+    bodies = []
+    byBody = {}
+    for document in documents:
+        body = json.dumps({'index': index, 'id': documentKey(document), 'document': document})
+        bodies.append(body)
+        byBody[body] = document
+    failed = queue.send(bodies)
+    print("Queued {} of {} document(s) for indexing".format(len(bodies) - len(failed), len(bodies)))
+    return [byBody[body] for body in failed]
+
+class ESIndexBuffer:
+    # Collects page documents from many producers and indexes them in large
+    # bulk requests once maxDocs, maxBytes or maxWaitSeconds is reached.
+    # Documents are indexed under a deterministic _id, so redelivered
+    # messages overwrite instead of duplicating. Receipts are only handed
+    # back as acknowledged once their document was indexed.
+    def __init__(self, esCluster, index, maxDocs=ES_BUFFER_MAX_DOCS, maxBytes=ES_BUFFER_MAX_BYTES, maxWaitSeconds=ES_BUFFER_MAX_WAIT, writeMode=None):
+        self._es = esCluster
+        self._index = index
+        self._writeMode = writeMode
+        self._maxDocs = maxDocs
+        self._maxBytes = maxBytes
+        self._maxWaitSeconds = maxWaitSeconds
+        self._pending = OrderedDict()
+        self._bytes = 0
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, body, receipt=None):
+        message = json.loads(body) if isinstance(body, str) else body
+        key = (message.get('index') or self._index, message['id'])
+        size = len((body if isinstance(body, str) else json.dumps(message['document'])).encode('utf-8'))
+        if key in self._pending:
+            # The same page queued twice; index the latest copy once
+            previous = self._pending[key]
+            self._bytes = self._bytes - previous['size']
+            previous['document'] = message['document']
+            previous['size'] = size
+            previous['receipts'].append(receipt)
+        else:
+            self._pending[key] = {'document': message['document'], 'size': size, 'receipts': [receipt]}
+        self._bytes = self._bytes + size
+        if self._oldest is None:
+            self._oldest = time.time()
+
+    def isFull(self):
+        return len(self._pending) >= self._maxDocs or self._bytes >= self._maxBytes
+
+    def isExpired(self):
+        return self._oldest is not None and time.time() - self._oldest >= self._maxWaitSeconds
+
+    def shouldFlush(self):
+        return self.isFull() or self.isExpired()
+
+    def flush(self):
+        # Returns (acknowledged, failed) receipts
+        if not self._pending:
+            return [], []
+        pending = self._pending
+        self._pending = OrderedDict()
+        self._bytes = 0
+        self._oldest = None
+
+        actions = [pageAction(index, id, entry['document'], self._writeMode)
+                   for (index, id), entry in pending.items()]
+        # Failures are matched on _id alone: when the index name is an alias
+        # the response carries the concrete index instead. Ids are
+        # deterministic, so they identify the page on their own.
+        failedIds = set()
+        try:
+            for index in set(index for index, id in pending.keys()):
+                self._es.ensureIndexTemplate(index)
+            stats = self._es.post_bulk(index=self._index, payload=actions, raiseOnError=False)
+            for error in stats['errors']:
+                info = list(error.values())[0]
+                failedIds.add(info.get('_id'))
+        except Exception as e:
+            print("Bulk indexing of {} buffered document(s) failed: {}".format(len(actions), e))
+            failedIds = set(id for index, id in pending.keys())
+
+        acknowledged = []
+        failed = []
+        for key, entry in pending.items():
+            receipts = [receipt for receipt in entry['receipts'] if receipt is not None]
+            if key[1] in failedIds:
+                failed.extend(receipts)
+            else:
+                acknowledged.extend(receipts)
+        print("Flushed {} buffered document(s): {} failed".format(len(actions), len(failedIds)))
+        return acknowledged, failed
+
+def drainQueue(queue, buffer, maxMessages=None, waitSeconds=0):
+    # Polling consumer: receives until the queue is empty (or maxMessages is
+    # reached), flushing whenever the buffer hits a threshold. Failed
+    # messages are left on the queue to be redelivered, and draining stops
+    # at the first failed flush instead of spinning on them.
+    received = 0
+    indexed = 0
+    while maxMessages is None or received < maxMessages:
+        messages = queue.receive(SQS_BATCH_SIZE, waitSeconds)
+        if not messages:
+            break
+        for message in messages:
+            buffer.add(message['body'], message['receipt'])
+        received = received + len(messages)
+        if buffer.shouldFlush():
+            acknowledged, failed = buffer.flush()
+            queue.delete(acknowledged)
+            indexed = indexed + len(acknowledged)
+            if failed:
+                break
+    acknowledged, failed = buffer.flush()
+    queue.delete(acknowledged)
+    indexed = indexed + len(acknowledged)
+    return {'received': received, 'indexed': indexed}
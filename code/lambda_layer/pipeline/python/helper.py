@@ -3,6 +3,9 @@ from botocore.client import Config
 import os
 import csv
 import io
+import threading
+import time
+import urllib.parse
 from boto3.dynamodb.conditions import Key
 from boto3.dynamodb.types import TypeDeserializer
 
@@ -60,45 +63,74 @@ class DynamoDBHelper:
                 print("Deleted...")
 
 class AwsHelper:
-    def getClient(self, name, awsRegion=None):
-        config = Config(
+    # Clients and resources are cached for the life of the container so warm
+    # invocations (and repeated calls within one) reuse the same connection pool.
+    _cache = {}
+    _cacheLock = threading.Lock()
+    _hits = 0
+    _misses = 0
+
+    @staticmethod
+    def _getConfig():
+        return Config(
             retries = dict(
                 max_attempts = 30
             )
         )
-        if(awsRegion):
-            return boto3.client(name, region_name=awsRegion, config=config)
-        else:
-            return boto3.client(name, config=config)
+
+    def _getCached(self, kind, name, awsRegion, factory):
+        key = (kind, name, awsRegion)
+        with AwsHelper._cacheLock:
+            if key in AwsHelper._cache:
+                AwsHelper._hits += 1
+                return AwsHelper._cache[key]
+            AwsHelper._misses += 1
+            if(awsRegion):
+                obj = factory(name, region_name=awsRegion, config=AwsHelper._getConfig())
+            else:
+                obj = factory(name, config=AwsHelper._getConfig())
+            AwsHelper._cache[key] = obj
+            return obj
+
+    def getClient(self, name, awsRegion=None):
+        return self._getCached("client", name, awsRegion, boto3.client)
 
     def getResource(self, name, awsRegion=None):
-        config = Config(
-            retries = dict(
-                max_attempts = 30
-            )
-        )
+        return self._getCached("resource", name, awsRegion, boto3.resource)
 
-        if(awsRegion):
-            return boto3.resource(name, region_name=awsRegion, config=config)
-        else:
-            return boto3.resource(name, config=config)
+    @staticmethod
+    def getCacheStats():
+        with AwsHelper._cacheLock:
+            return {
+                "hits"   : AwsHelper._hits,
+                "misses" : AwsHelper._misses,
+                "size"   : len(AwsHelper._cache)
+            }
+
+    @staticmethod
+    def clearCache():
+        with AwsHelper._cacheLock:
+            AwsHelper._cache.clear()
+            AwsHelper._hits = 0
+            AwsHelper._misses = 0
 
 class S3Helper:
     @staticmethod
     def getS3BucketRegion(bucketName):
-        client = boto3.client('s3')
+        client = AwsHelper().getClient('s3')
         response = client.get_bucket_location(Bucket=bucketName)
         awsRegion = response['LocationConstraint']
         return awsRegion
 
     @staticmethod
     def writeToS3(content, bucketName, s3FileName, taggingStr=None, awsRegion=None):
-        s3 = AwsHelper().getResource('s3', awsRegion)
-        object = s3.Object(bucketName, s3FileName)
+        # Clients (unlike resources) are thread-safe, so the cached client can be
+        # shared by concurrent page uploads.
+        s3 = AwsHelper().getClient('s3', awsRegion)
         if taggingStr:
-            object.put(Body=content, Tagging=taggingStr)
+            s3.put_object(Bucket=bucketName, Key=s3FileName, Body=content, Tagging=taggingStr)
         else:
-            object.put(Body=content)
+            s3.put_object(Bucket=bucketName, Key=s3FileName, Body=content)
 
     @staticmethod
     def getTagsS3(bucketName, s3FileName, awsRegion=None):
@@ -112,6 +144,16 @@ class S3Helper:
             tag_dict[tag['Key']] = tag['Value']
         return tag_dict
     
+    @staticmethod
+    def documentTagging(documentId, documentVersion=None):
+        # Tagging string for pipeline outputs. documentVersion (the S3
+        # versionId of the upload) is carried along so that indexed pages can
+        # later be deleted per version.
+        tags = {"documentId": documentId}
+        if documentVersion:
+            tags["documentVersion"] = documentVersion
+        return urllib.parse.urlencode(tags)
+
     @staticmethod
     def getS3ObjectUrl(bucketName, s3FileName, awsRegion=None):
         s3 = AwsHelper().getClient('s3', awsRegion)
@@ -144,12 +186,14 @@ class S3Helper:
         )
 
     @staticmethod
-    def copyToS3(sourceBucketName, sourceFilename, targetBucketName, targetFileName, awsRegion=None):
+    def copyToS3(sourceBucketName, sourceFilename, targetBucketName, targetFileName, awsRegion=None, sourceVersionId=None):
         s3 = AwsHelper().getClient('s3', awsRegion)
         copy_source = {
             'Bucket': sourceBucketName,
             'Key': sourceFilename
         }
+        if sourceVersionId:
+            copy_source['VersionId'] = sourceVersionId
         s3.copy_object(
             Bucket           = targetBucketName,
             CopySource       = copy_source,
@@ -212,6 +256,93 @@ class S3Helper:
         S3Helper.writeToS3(csv_file.getvalue(), bucketName, s3FileName)
 
 
+class S3MultipartWriter:
+    # Streams text to a single S3 object with a multipart upload, holding at
+    # most one part in memory. Objects smaller than one part are sent with a
+    # plain put_object on close.
+    MIN_PART_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, bucketName, s3FileName, taggingStr=None, awsRegion=None, partSize=MIN_PART_SIZE):
+        self._s3 = AwsHelper().getClient('s3', awsRegion)
+        self._bucketName = bucketName
+        self._s3FileName = s3FileName
+        self._taggingStr = taggingStr
+        self._partSize = max(partSize, 5 * 1024 * 1024)
+        self._buffer = io.BytesIO()
+        self._uploadId = None
+        self._parts = []
+
+    def write(self, content):
+        self._buffer.write(content.encode('utf-8'))
+        if self._buffer.tell() >= self._partSize:
+            self._flushPart()
+
+    def _flushPart(self):
+        if self._uploadId is None:
+            args = {
+                'Bucket': self._bucketName,
+                'Key'   : self._s3FileName
+            }
+            if self._taggingStr:
+                args['Tagging'] = self._taggingStr
+            self._uploadId = self._s3.create_multipart_upload(**args)['UploadId']
+        partNumber = len(self._parts) + 1
+        response = self._s3.upload_part(
+            Bucket     = self._bucketName,
+            Key        = self._s3FileName,
+            UploadId   = self._uploadId,
+            PartNumber = partNumber,
+            Body       = self._buffer.getvalue()
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': partNumber})
+        self._buffer = io.BytesIO()
+
+    def close(self):
+        if self._uploadId is None:
+            S3Helper.writeToS3(self._buffer.getvalue(), self._bucketName, self._s3FileName, self._taggingStr)
+            return
+        if self._buffer.tell() > 0:
+            self._flushPart()
+        self._s3.complete_multipart_upload(
+            Bucket          = self._bucketName,
+            Key             = self._s3FileName,
+            UploadId        = self._uploadId,
+            MultipartUpload = {'Parts': self._parts}
+        )
+
+    def abort(self):
+        if self._uploadId is not None:
+            self._s3.abort_multipart_upload(
+                Bucket   = self._bucketName,
+                Key      = self._s3FileName,
+                UploadId = self._uploadId
+            )
+        self._buffer = io.BytesIO()
+
+class RateLimiter:
+    # Thread-safe token bucket allowing at most `rate` acquisitions per second
+    # (with bursts of up to `burst`); acquire() blocks until a token is free.
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._capacity = float(burst if burst else max(1, int(rate)))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens = self._tokens - 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
 class FileHelper:
     @staticmethod
     def getFileNameAndExtension(filePath):
@@ -1,12 +1,114 @@
 import sys, os
 import json
+import functools
 import boto3
 from helper import AwsHelper
 import datetime
 import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# sync publishes every message on its own; buffered queues messages and
+# sends them with publish_batch when 10 are pending or on flushMetadata();
+# background additionally sends full batches on a worker thread
+METADATA_PUBLISH_MODE = os.environ.get('METADATA_PUBLISH_MODE', 'buffered')
+SNS_BATCH_SIZE        = 10
+SNS_MAX_BATCH_BYTES   = 256 * 1024
+
+# One publisher per topic, shared by every client in the container, so
+# messages keep their publish order across clients
+_publishers = {}
+_publishersLock = threading.Lock()
+
+class SNSBatchPublisher:
+    def __init__(self, client, topicArn, background=False):
+        self._client = client
+        self._topicArn = topicArn
+        self._entries = []
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._futures = []
+        # A single worker keeps batches, and so each message group, in order
+        self._executor = ThreadPoolExecutor(max_workers=1) if background else None
+
+    def add(self, message, messageGroupId, messageAttributes):
+        size = len(message.encode('utf-8'))
+        with self._lock:
+            if self._entries and self._bytes + size > SNS_MAX_BATCH_BYTES:
+                self._dispatch()
+            self._entries.append({
+                'Message':           message,
+                'MessageGroupId':    messageGroupId,
+                'MessageAttributes': messageAttributes
+            })
+            self._bytes = self._bytes + size
+            if len(self._entries) >= SNS_BATCH_SIZE:
+                self._dispatch()
+
+    def _dispatch(self):
+        entries = self._entries
+        self._entries = []
+        self._bytes = 0
+        if self._executor:
+            self._futures.append(self._executor.submit(self._send, entries))
+        else:
+            self._send(entries)
+
+    def _send(self, entries):
+        try:
+            response = self._client.publish_batch(
+                TopicArn = self._topicArn,
+                PublishBatchRequestEntries = [{'Id': str(i), **entry} for i, entry in enumerate(entries)]
+            )
+        except Exception as e:
+            print(e)
+            raise Exception("Unable to publish to topic {}".format(self._topicArn))
+        failed = sorted(int(failure['Id']) for failure in response.get('Failed', []))
+        # Retry rejected entries one at a time, in their original order
+        for index in failed:
+            try:
+                self._client.publish(TopicArn=self._topicArn, **entries[index])
+            except Exception as e:
+                print(e)
+                raise Exception("Unable to publish to topic {}".format(self._topicArn))
+        print("Published {} metadata message(s) to {} ({} retried)".format(len(entries), self._topicArn, len(failed)))
+
+    def flush(self):
+        with self._lock:
+            if self._entries:
+                self._dispatch()
+            futures = self._futures
+            self._futures = []
+        for future in futures:
+            future.result()
+
+def getPublisher(client, topicArn, publishMode):
+    key = (topicArn, publishMode)
+    with _publishersLock:
+        if key not in _publishers:
+            _publishers[key] = SNSBatchPublisher(client, topicArn, background=(publishMode == 'background'))
+        return _publishers[key]
+
+def flushMetadata():
+    # Call at the end of every handler; sends whatever is still buffered
+    with _publishersLock:
+        publishers = list(_publishers.values())
+    for publisher in publishers:
+        publisher.flush()
+
+def flushesMetadata(handler):
+    # Lambda handler decorator: buffered messages are sent before the
+    # container freezes, whether the handler returns or raises
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            flushMetadata()
+    return wrapper
 
 class MetadataClient:
-    def __init__(self, targetArn, targetType="sns", region=None, body=None):
+    def __init__(self, targetArn, targetType="sns", region=None, body=None, publishMode=None):
         metadataType = "generic"
         
         if region == None:
@@ -19,6 +121,9 @@ class MetadataClient:
         self._client        = AwsHelper().getClient(self._targetType, awsRegion=self._region)
         self._metadataType  = metadataType
         self._requiredKeys  = set()
+        self._publishMode   = publishMode or METADATA_PUBLISH_MODE
+        if self._publishMode not in ['sync', 'buffered', 'background']:
+            raise ValueError("MetadataClient does not support publish mode {}".format(self._publishMode))
         if body and not isinstance(body, dict):
             raise ValueError("'body' has to be a valid dictionary")
         elif body == None:
@@ -64,22 +169,24 @@ class MetadataClient:
         return True
     
     def _publishSNS(self, message, messageGroupId, messageAttributes):
-        print("publishing to SNS")
+        if self._publishMode != 'sync':
+            getPublisher(self.client, self.targetArn, self._publishMode).add(message, messageGroupId, messageAttributes)
+            return
         try:
-            print(self.client.publish(
+            response = self.client.publish(
                 TopicArn       = self.targetArn,    
                 Message        = message,
                 MessageGroupId = messageGroupId,
-                MessageAttributes = {
-                    'metadataType': {
-                        'DataType'   : 'String',
-                        'StringValue': self.metadataType
-                    }
-                }
-            ))
+                MessageAttributes = messageAttributes
+            )
+            print("Published {} message {}".format(self.metadataType, response.get('MessageId')))
         except Exception as e:
             print(e)
             raise Exception("Unable to publish to topic {}".format(self.targetArn))
+
+    def flush(self):
+        if self._publishMode != 'sync':
+            getPublisher(self.client, self.targetArn, self._publishMode).flush()
     
     
     def publish(self, body, subsetKeys=[]):
@@ -107,8 +214,8 @@ class MetadataClient:
             raise ValueError("Invalid targetType")
     
 class PipelineOperationsClient(MetadataClient):
-    def __init__(self, targetArn, region=None, targetType="sns", body=None):
-        super().__init__(targetArn, targetType, region, body)
+    def __init__(self, targetArn, region=None, targetType="sns", body=None, publishMode=None):
+        super().__init__(targetArn, targetType, region, body, publishMode)
         self._metadataType = "pipeline-operations"
         self._requiredKeys = {"documentId", "bucketName", "objectName", "status", "stage"}
     
@@ -152,8 +259,8 @@ class PipelineOperationsClient(MetadataClient):
             })
     
 class DocumentLineageClient(MetadataClient):
-    def __init__(self, targetArn, region=None, targetType="sns", body=None):
-        super().__init__(targetArn, targetType, region, body)
+    def __init__(self, targetArn, region=None, targetType="sns", body=None, publishMode=None):
+        super().__init__(targetArn, targetType, region, body, publishMode)
         self._metadataType = "document-lineage"
         self._requiredKeys =  {"documentId", "callerId", "targetBucketName", "targetFileName", "s3Event"}
 
@@ -171,8 +278,8 @@ class DocumentLineageClient(MetadataClient):
         super().publish({"s3Event": "ObjectCreated:Copy", **body})
     
 class DocumentRegistryClient(MetadataClient):
-    def __init__(self, targetArn, region=None, targetType="sns", body=None):
-        super().__init__(targetArn, targetType, region, body)
+    def __init__(self, targetArn, region=None, targetType="sns", body=None, publishMode=None):
+        super().__init__(targetArn, targetType, region, body, publishMode)
         self._metadataType = "document-registry"
         self._requiredKeys =  {"documentId", "bucketName", "documentName", "documentLink", "principalIAMWriter"}
 
@@ -1,8 +1,14 @@
 import json
-from helper import FileHelper, S3Helper
-from trp import Document
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from helper import FileHelper, S3Helper, S3MultipartWriter
+from trp import Document, iterPages
 import boto3
 
+DEFAULT_UPLOAD_CONCURRENCY = int(os.environ.get('OUTPUT_UPLOAD_CONCURRENCY', 8))
+
 class OutputGenerator:
     
     def __init__(self, response, forms, tables, **kwargs):
@@ -12,23 +18,26 @@ class OutputGenerator:
         self.documentId = kwargs.get("documentId", None)
         self.bucketName = kwargs.get("bucketName", None)
         self.objectName = kwargs.get("objectName", None)
+        self.uploadConcurrency = kwargs.get("uploadConcurrency", DEFAULT_UPLOAD_CONCURRENCY)
         self.outputPath = "{}/ocr-analysis".format(self.objectName)
-        self.document = Document(self.response)
+        # A dict or list response is parsed up front; any other iterable of
+        # responses (e.g. async result files read one at a time) is streamed
+        # page by page by writeTextractOutputs.
+        # An already parsed Document can be passed in to avoid parsing twice.
+        self.streaming = not isinstance(self.response, (dict, list))
+        self.document = kwargs.get("document", None)
+        if(self.document is None and not self.streaming):
+            self.document = Document(self.response, lazy=True)
+        self._renderedPages = weakref.WeakKeyDictionary()
 
-    def _outputText(self, page, p, no_write=False):
-        text = page.text
-        textInReadingOrder = page.getTextInReadingOrder()
-        
-        if no_write:
-            return (text, textInReadingOrder)
-        else:
-            opath = "{}/page-{}/text.txt".format(self.outputPath, p)
-            opath = "{}/page-{}/text-inreadingorder.txt".format(self.outputPath, p)
-            S3Helper.writeToS3(textInReadingOrder, self.bucketName, opath)
-            S3Helper.writeToS3(text, self.bucketName, opath)
+    def renderPage(self, page):
+        # Plain text, reading-order text, form rows and table rows are produced
+        # together and cached for as long as the page object is alive
+        rendered = self._renderedPages.get(page)
+        if rendered is not None:
+            return rendered
 
-    def _outputForm(self, page, p, no_write=False):
-        csvData = []
+        formRows = []
         for field in page.form.fields:
             csvItem  = []
             if(field.key):
@@ -39,27 +48,54 @@ class OutputGenerator:
                 csvItem.append(field.value.text)
             else:
                 csvItem.append("")
-            csvData.append(csvItem)
-        if no_write:
-            return csvData
-        else:
-            csvFieldNames = ['Key', 'Value']
-            opath = "{}/page-{}/forms.csv".format(self.outputPath, p)
-            S3Helper.writeCSV(csvFieldNames, csvData, self.bucketName, opath)
+            formRows.append(csvItem)
 
-    def _outputTable(self, page, p, no_write=False):
-        csvData = []
+        tableRows = []
         for table in page.tables:
             csvRow = []
             csvRow.append("Table")
-            csvData.append(csvRow)
+            tableRows.append(csvRow)
             for row in table.rows:
                 csvRow  = []
                 for cell in row.cells:
                     csvRow.append(cell.text)
-                csvData.append(csvRow)
-            csvData.append([])
-            csvData.append([])
+                tableRows.append(csvRow)
+            tableRows.append([])
+            tableRows.append([])
+
+        rendered = {
+            "text"               : page.text,
+            "textInReadingOrder" : page.getTextInReadingOrder(),
+            "forms"              : formRows,
+            "tables"             : tableRows
+        }
+        self._renderedPages[page] = rendered
+        return rendered
+
+    def _outputText(self, page, p, no_write=False):
+        rendered = self.renderPage(page)
+        text = rendered["text"]
+        textInReadingOrder = rendered["textInReadingOrder"]
+        
+        if no_write:
+            return (text, textInReadingOrder)
+        else:
+            opath = "{}/page-{}/text.txt".format(self.outputPath, p)
+            S3Helper.writeToS3(text, self.bucketName, opath)
+            opath = "{}/page-{}/text-inreadingorder.txt".format(self.outputPath, p)
+            S3Helper.writeToS3(textInReadingOrder, self.bucketName, opath)
+
+    def _outputForm(self, page, p, no_write=False):
+        csvData = self.renderPage(page)["forms"]
+        if no_write:
+            return csvData
+        else:
+            csvFieldNames = ['Key', 'Value']
+            opath = "{}/page-{}/forms.csv".format(self.outputPath, p)
+            S3Helper.writeCSV(csvFieldNames, csvData, self.bucketName, opath)
+
+    def _outputTable(self, page, p, no_write=False):
+        csvData = self.renderPage(page)["tables"]
         if no_write:
             return csvData
         else:
@@ -76,22 +112,101 @@ class OutputGenerator:
         text, structuredText = self._outputText(page, 0, no_write=True)
         return structuredText
 
+    def _outputPage(self, page, p, taggingStr=None):
+        opath = "{}/page-{}/response.json".format(self.outputPath, p)
+        S3Helper.writeToS3(json.dumps(page.blocks), self.bucketName, opath, taggingStr)
+        self._outputText(page, p)
+        objectCount = 3
+        if(self.forms):
+            self._outputForm(page, p)
+            objectCount = objectCount + 1
+        if(self.tables):
+            self._outputTable(page, p)
+            objectCount = objectCount + 1
+        return objectCount
+
+    def _outputPages(self, pages, taggingStr=None):
+        pageCount = 0
+        objectCount = 0
+        if self.uploadConcurrency <= 1:
+            for page in pages:
+                pageCount = pageCount + 1
+                objectCount = objectCount + self._outputPage(page, pageCount, taggingStr)
+            return (pageCount, objectCount)
+
+        # Keep a bounded window of pages in flight so rendered output for the
+        # whole document is never held in memory at once.
+        maxPending = self.uploadConcurrency * 2
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.uploadConcurrency) as executor:
+            try:
+                for page in pages:
+                    if len(pending) >= maxPending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            objectCount = objectCount + future.result()
+                    pageCount = pageCount + 1
+                    pending.add(executor.submit(self._outputPage, page, pageCount, taggingStr))
+                for future in pending:
+                    objectCount = objectCount + future.result()
+            except Exception:
+                for future in pending:
+                    future.cancel()
+                raise
+        return (pageCount, objectCount)
+
+    def _uploadMetrics(self, startTime, pageCount, objectCount):
+        elapsed = max(time.time() - startTime, 0.001)
+        metrics = {
+            "documentId"    : self.documentId,
+            "pages"         : pageCount,
+            "objects"       : objectCount,
+            "seconds"       : round(elapsed, 3),
+            "objectsPerSec" : round(objectCount / elapsed, 2),
+            "pagesPerSec"   : round(pageCount / elapsed, 2),
+            "concurrency"   : self.uploadConcurrency
+        }
+        print("Textract output upload metrics: {}".format(metrics))
+        return metrics
+
+    def _streamResponses(self, writer):
+        # Pass each response through while appending it to fullresponse.json
+        writer.write("[")
+        first = True
+        for response in self.response:
+            if not first:
+                writer.write(", ")
+            writer.write(json.dumps(response))
+            first = False
+            yield response
+        writer.write("]")
+
+    def _writeStreamedTextractOutputs(self, taggingStr=None):
+        startTime = time.time()
+        opath = "{}/fullresponse.json".format(self.outputPath)
+        writer = S3MultipartWriter(self.bucketName, opath, taggingStr)
+        try:
+            pageCount, objectCount = self._outputPages(iterPages(self._streamResponses(writer)), taggingStr)
+        except Exception:
+            writer.abort()
+            raise
+        if pageCount == 0:
+            writer.abort()
+            return
+        # Write the whole output for it to then be used for comprehend
+        print("Total Pages in Document: {}".format(pageCount))
+        writer.close()
+        return self._uploadMetrics(startTime, pageCount, objectCount + 1)
+
     def writeTextractOutputs(self, taggingStr=None):
+        if self.streaming:
+            return self._writeStreamedTextractOutputs(taggingStr)
         if not self.document.pages:
             return
-        docText = ""
-        p = 1
-        for page in self.document.pages:
-            opath = "{}/page-{}/response.json".format(self.outputPath, p)
-            S3Helper.writeToS3(json.dumps(page.blocks), self.bucketName, opath, taggingStr)
-            self._outputText(page, p)
-            docText = docText + page.text + "\n"
-            if(self.forms):
-                self._outputForm(page, p)
-            if(self.tables):
-                self._outputTable(page, p)
-            p = p + 1
+        startTime = time.time()
+        pageCount, objectCount = self._outputPages(self.document.iterPages(release=True), taggingStr)
         # Write the whole output for it to then be used for comprehend
         opath = "{}/fullresponse.json".format(self.outputPath)
-        print("Total Pages in Document: {}".format(len(self.document.pages)))
-        S3Helper.writeToS3(json.dumps(self.response), self.bucketName, opath, taggingStr)
\ No newline at end of file
+        print("Total Pages in Document: {}".format(pageCount))
+        S3Helper.writeToS3(json.dumps(self.response), self.bucketName, opath, taggingStr)
+        return self._uploadMetrics(startTime, pageCount, objectCount + 1)
@@ -1,6 +1,13 @@
 import json
+from array import array
+import re
+from bisect import bisect_left, bisect_right
+
+import numpy as np
 
 class BoundingBox:
+    __slots__ = ('_width', '_height', '_left', '_top')
+
     def __init__(self, width, height, left, top):
         self._width = width
         self._height = height
@@ -27,6 +34,8 @@ class BoundingBox:
         return self._top
 
 class Polygon:
+    __slots__ = ('_x', '_y')
+
     def __init__(self, x, y):
         self._x = x
         self._y = y
@@ -43,16 +52,20 @@ class Polygon:
         return self._y
 
 class Geometry:
+    __slots__ = ('_boundingBox', '_points')
+
     def __init__(self, geometry):
         boundingBox = geometry["BoundingBox"]
         polygon = geometry["Polygon"]
         bb = BoundingBox(boundingBox["Width"], boundingBox["Height"], boundingBox["Left"], boundingBox["Top"])
-        pgs = []
+        # Polygon points are kept as a flat [x0, y0, x1, y1, ...] float array
+        points = array('d')
         for pg in polygon:
-            pgs.append(Polygon(pg["X"], pg["Y"]))
+            points.append(pg["X"])
+            points.append(pg["Y"])
 
         self._boundingBox = bb
-        self._polygon = pgs
+        self._points = points
 
     def __str__(self):
         s = "BoundingBox: {}\n".format(str(self._boundingBox))
@@ -64,9 +77,56 @@ class Geometry:
 
     @property
     def polygon(self):
-        return self._polygon
+        points = self._points
+        return [Polygon(points[i], points[i + 1]) for i in range(0, len(points), 2)]
+
+    @property
+    def points(self):
+        return self._points
+
+# Per-page view over the document block map that materializes each Textract
+# block exactly once, so a WORD reached from a Line, a Cell and a Field is the
+# same Word object. It also records which line, cell and field contain each
+# word. Constructors accept either a plain block map dict or a BlockCache.
+class BlockCache:
+    def __init__(self, blockMap):
+        self._blockMap = blockMap
+        self._objects = {}
+        self._parents = {}
+
+    def __getitem__(self, blockId):
+        return self._blockMap[blockId]
+
+    def __contains__(self, blockId):
+        return blockId in self._blockMap
+
+    def get(self, blockId, default=None):
+        return self._blockMap.get(blockId, default)
+
+    def materialize(self, cls, block):
+        obj = self._objects.get(block['Id'])
+        if obj is None:
+            obj = self._objects.setdefault(block['Id'], cls(block, self))
+        return obj
+
+    def addParent(self, child, kind, parent):
+        self._parents.setdefault(child.id, {})[kind] = parent
+
+    def getParents(self, blockId):
+        return self._parents.get(blockId, {})
+
+def _materialize(cls, block, blockMap):
+    if isinstance(blockMap, BlockCache):
+        return blockMap.materialize(cls, block)
+    return cls(block, blockMap)
+
+def _addParent(blockMap, child, kind, parent):
+    if isinstance(blockMap, BlockCache):
+        blockMap.addParent(child, kind, parent)
 
 class Word:
+    __slots__ = ('_block', '_confidence', '_geometry', '_id', '_text')
+
     def __init__(self, block, blockMap):
         self._block = block
         self._confidence = block['Confidence']
@@ -100,6 +160,8 @@ class Word:
         return self._block
 
 class Line:
+    __slots__ = ('_block', '_confidence', '_geometry', '_id', '_text', '_words')
+
     def __init__(self, block, blockMap):
         self._block = block
         self._confidence = block['Confidence']
@@ -116,7 +178,9 @@ class Line:
                     for cid in rs['Ids']:
                         if cid in blockMap:
                             if(blockMap[cid]["BlockType"] == "WORD"):
-                                self._words.append(Word(blockMap[cid], blockMap))
+                                w = _materialize(Word, blockMap[cid], blockMap)
+                                _addParent(blockMap, w, "line", self)
+                                self._words.append(w)
     def __str__(self):
         s = "Line\n==========\n"
         s = s + self._text + "\n"
@@ -150,6 +214,8 @@ class Line:
         return self._block
 
 class SelectionElement:
+    __slots__ = ('_confidence', '_geometry', '_id', '_selectionStatus')
+
     def __init__(self, block, blockMap):
         self._confidence = block['Confidence']
         self._geometry = Geometry(block['Geometry'])
@@ -186,7 +252,7 @@ class FieldKey:
         for eid in children:
             wb = blockMap[eid]
             if(wb['BlockType'] == "WORD"):
-                w = Word(wb, blockMap)
+                w = _materialize(Word, wb, blockMap)
                 self._content.append(w)
                 t.append(w.text)
 
@@ -234,11 +300,11 @@ class FieldValue:
         for eid in children:
             wb = blockMap[eid]
             if(wb['BlockType'] == "WORD"):
-                w = Word(wb, blockMap)
+                w = _materialize(Word, wb, blockMap)
                 self._content.append(w)
                 t.append(w.text)
             elif(wb['BlockType'] == "SELECTION_ELEMENT"):
-                se = SelectionElement(wb, blockMap)
+                se = _materialize(SelectionElement, wb, blockMap)
                 self._content.append(se)
                 self._text = se.selectionStatus
 
@@ -288,6 +354,11 @@ class Field:
                             for vitem in vkvs['Relationships']:
                                 if(vitem["Type"] == "CHILD"):
                                     self._value = FieldValue(vkvs, vitem['Ids'], blockMap)
+        for part in (self._key, self._value):
+            if(part):
+                for w in part.content:
+                    if(isinstance(w, Word)):
+                        _addParent(blockMap, w, "field", self)
     def __str__(self):
         s = "\nField\n==========\n"
         k = ""
@@ -307,14 +378,127 @@ class Field:
     def value(self):
         return self._value
 
+def _editDistance(a, b, maxDistance):
+    # Levenshtein distance, giving up (returning maxDistance + 1) once every
+    # cell of a row exceeds maxDistance
+    if abs(len(a) - len(b)) > maxDistance:
+        return maxDistance + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > maxDistance:
+            return maxDistance + 1
+        previous = current
+    return previous[-1]
+
+# BK-tree over normalized keys for edit-distance lookups that only visit the
+# part of the tree within the search radius
+class _BKTree:
+    def __init__(self):
+        self._root = None
+
+    def add(self, key):
+        if self._root is None:
+            self._root = (key, {})
+            return
+        node = self._root
+        while True:
+            distance = _editDistance(key, node[0], max(len(key), len(node[0])))
+            if distance == 0:
+                return
+            if distance not in node[1]:
+                node[1][distance] = (key, {})
+                return
+            node = node[1][distance]
+
+    def search(self, key, maxDistance):
+        results = []
+        if self._root is None:
+            return results
+        stack = [self._root]
+        while stack:
+            nodeKey, children = stack.pop()
+            distance = _editDistance(key, nodeKey, max(len(key), len(nodeKey)))
+            if distance <= maxDistance:
+                results.append((distance, nodeKey))
+            for childDistance, child in children.items():
+                if distance - maxDistance <= childDistance <= distance + maxDistance:
+                    stack.append(child)
+        return results
+
+class FormIndex:
+    # Lookup structures over form field keys. Keys are normalized (case,
+    # whitespace and punctuation) and any number of fields may share a key.
+
+    @staticmethod
+    def normalize(key):
+        return ' '.join(re.sub(r'[^\w\s]', ' ', key.lower()).split())
+
+    def __init__(self):
+        self._fieldsByKey = {}
+        self._keysByToken = {}
+        self._sortedKeys = []
+        self._sorted = True
+        self._bkTree = _BKTree()
+
+    def addField(self, field):
+        key = FormIndex.normalize(field.key.text)
+        if key not in self._fieldsByKey:
+            self._fieldsByKey[key] = []
+            for token in key.split():
+                self._keysByToken.setdefault(token, set()).add(key)
+            self._sortedKeys.append(key)
+            self._sorted = False
+            self._bkTree.add(key)
+        self._fieldsByKey[key].append(field)
+
+    def _fieldsForKeys(self, keys):
+        results = []
+        for key in keys:
+            results.extend(self._fieldsByKey[key])
+        return results
+
+    def getFields(self, key):
+        return list(self._fieldsByKey.get(FormIndex.normalize(key), []))
+
+    def searchByTokens(self, key):
+        # fields whose key contains every token of the query
+        tokens = FormIndex.normalize(key).split()
+        if not tokens:
+            return []
+        keySets = sorted((self._keysByToken.get(token, set()) for token in tokens), key=len)
+        keys = set(keySets[0]).intersection(*keySets[1:])
+        return self._fieldsForKeys(sorted(keys))
+
+    def searchByPrefix(self, prefix):
+        if not self._sorted:
+            self._sortedKeys.sort()
+            self._sorted = True
+        prefix = FormIndex.normalize(prefix)
+        index = bisect_left(self._sortedKeys, prefix)
+        keys = []
+        while index < len(self._sortedKeys) and self._sortedKeys[index].startswith(prefix):
+            keys.append(self._sortedKeys[index])
+            index = index + 1
+        return self._fieldsForKeys(keys)
+
+    def searchFuzzy(self, key, maxDistance=2):
+        # fields whose normalized key is within maxDistance edits, closest first
+        matches = sorted(self._bkTree.search(FormIndex.normalize(key), maxDistance))
+        return self._fieldsForKeys([match[1] for match in matches])
+
 class Form:
     def __init__(self):
         self._fields = []
         self._fieldsMap = {}
+        self._index = FormIndex()
 
     def addField(self, field):
         self._fields.append(field)
         self._fieldsMap[field.key.text] = field
+        self._index.addField(field)
 
     def __str__(self):
         s = ""
@@ -340,7 +524,25 @@ class Form:
                 results.append(field)
         return results
 
+    @property
+    def index(self):
+        return self._index
+
+    def getFieldsByKey(self, key):
+        return self._index.getFields(key)
+
+    def searchFieldsByTokens(self, key):
+        return self._index.searchByTokens(key)
+
+    def searchFieldsByPrefix(self, prefix):
+        return self._index.searchByPrefix(prefix)
+
+    def searchFieldsFuzzy(self, key, maxDistance=2):
+        return self._index.searchFuzzy(key, maxDistance)
+
 class Cell:
+    __slots__ = ('_block', '_confidence', '_rowIndex', '_columnIndex', '_rowSpan', '_columnSpan',
+                 '_geometry', '_id', '_content', '_text')
 
     def __init__(self, block, blockMap):
         self._block = block
@@ -360,11 +562,12 @@ class Cell:
                         if cid in blockMap:
                             blockType = blockMap[cid]["BlockType"]
                             if(blockType == "WORD"):
-                                w = Word(blockMap[cid], blockMap)
+                                w = _materialize(Word, blockMap[cid], blockMap)
+                                _addParent(blockMap, w, "cell", self)
                                 self._content.append(w)
                                 self._text = self._text + w.text + ' '
                             elif(blockType == "SELECTION_ELEMENT"):
-                                se = SelectionElement(blockMap[cid], blockMap)
+                                se = _materialize(SelectionElement, blockMap[cid], blockMap)
                                 self._content.append(se)
                                 self._text = self._text + se.selectionStatus + ', '
 
@@ -444,7 +647,7 @@ class Table:
             for rs in block['Relationships']:
                 if(rs['Type'] == 'CHILD'):
                     for cid in rs['Ids']:
-                        cell = Cell(blockMap[cid], blockMap)
+                        cell = _materialize(Cell, blockMap[cid], blockMap)
                         if(cell.rowIndex > ri):
                             self._rows.append(row)
                             row = Row()
@@ -482,19 +685,23 @@ class Table:
 
 class Page:
 
-    def __init__(self, blocks, blockMap):
+    def __init__(self, blocks, blockMap, lazy=False):
         self._blocks = blocks
+        self._blockMap = BlockCache(blockMap)
         self._text = ""
         self._lines = []
-        self._form = Form()
-        self._tables = []
-        self._content = []
+        self._form = None
+        self._tables = None
+        self._content = None
+        self._geometryStore = None
 
-        self._parse(blockMap)
+        self._parse(self._blockMap)
+        if(not lazy):
+            self._parseStructures()
 
     def __str__(self):
         s = "Page\n==========\n"
-        for item in self._content:
+        for item in self.content:
             s = s + str(item) + "\n"
         return s
 
@@ -504,53 +711,79 @@ class Page:
                 self._geometry = Geometry(item['Geometry'])
                 self._id = item['Id']
             elif item["BlockType"] == "LINE":
-                l = Line(item, blockMap)
+                l = _materialize(Line, item, blockMap)
                 self._lines.append(l)
-                self._content.append(l)
                 self._text = self._text + l.text + '\n'
+
+    def _parseStructures(self):
+        # Tables and form fields are the expensive part of a page, so in lazy
+        # mode they are only built the first time tables, form or content is used.
+        if(self._content is not None):
+            return
+        blockMap = self._blockMap
+        form = Form()
+        tables = []
+        content = []
+        lineIndex = 0
+        for item in self._blocks:
+            if item["BlockType"] == "LINE":
+                content.append(self._lines[lineIndex])
+                lineIndex = lineIndex + 1
             elif item["BlockType"] == "TABLE":
                 t = Table(item, blockMap)
-                self._tables.append(t)
-                self._content.append(t)
+                tables.append(t)
+                content.append(t)
             elif item["BlockType"] == "KEY_VALUE_SET":
                 if 'KEY' in item['EntityTypes']:
                     f = Field(item, blockMap)
                     if(f.key):
-                        self._form.addField(f)
-                        self._content.append(f)
+                        form.addField(f)
+                        content.append(f)
                     else:
                         print("WARNING: Detected K/V where key does not have content. Excluding key from output.")
                         print(f)
                         print(item)
+        self._form = form
+        self._tables = tables
+        self._content = content
+
+    # Lines at least this many times wider than the median line are treated as
+    # spanning several columns (headers, footers) and do not seed columns
+    SPANNING_LINE_FACTOR = 2.0
+
+    def _columnsInReadingOrder(self):
+        if not self._lines:
+            return []
+        store = self.geometryStore
+        ordinals = np.array([store.ordinal(line.id) for line in self._lines])
+        positions = {ordinal: position for position, ordinal in enumerate(ordinals)}
+        return [[self._lines[positions[ordinal]] for ordinal in column]
+                for column in store.columnsInReadingOrder(ordinals, Page.SPANNING_LINE_FACTOR)]
+
+    # Geometry of this page's blocks, built on first use
+    @property
+    def geometryStore(self):
+        if(self._geometryStore is None):
+            self._geometryStore = GeometryStore([{"Blocks": self._blocks}])
+        return self._geometryStore
+
+    # Returns the objects containing a word on this page, as a dict with any of
+    # the keys "line", "cell" and "field"
+    def getWordParents(self, word):
+        self._parseStructures()
+        wordId = word if isinstance(word, str) else word.id
+        return self._blockMap.getParents(wordId)
 
     def getLinesInReadingOrder(self):
-        columns = []
         lines = []
-        for item in self._lines:
-                column_found=False
-                for index, column in enumerate(columns):
-                    bbox_left = item.geometry.boundingBox.left
-                    bbox_right = item.geometry.boundingBox.left + item.geometry.boundingBox.width
-                    bbox_centre = item.geometry.boundingBox.left + item.geometry.boundingBox.width/2
-                    column_centre = column['left'] + column['right']/2
-                    if (bbox_centre > column['left'] and bbox_centre < column['right']) or (column_centre > bbox_left and column_centre < bbox_right):
-                        #Bbox appears inside the column
-                        lines.append([index, item.text])
-                        column_found=True
-                        break
-                if not column_found:
-                    columns.append({'left':item.geometry.boundingBox.left, 'right':item.geometry.boundingBox.left + item.geometry.boundingBox.width})
-                    lines.append([len(columns)-1, item.text])
-
-        lines.sort(key=lambda x: x[0])
+        for index, column in enumerate(self._columnsInReadingOrder()):
+            for line in column:
+                lines.append([index, line.text])
         return lines
 
     def getTextInReadingOrder(self):
         lines = self.getLinesInReadingOrder()
-        text = ""
-        for line in lines:
-            text = text + line[1] + '\n'
-        return text
+        return ''.join(line[1] + '\n' for line in lines)
 
     @property
     def blocks(self):
@@ -566,14 +799,17 @@ class Page:
 
     @property
     def form(self):
+        self._parseStructures()
         return self._form
 
     @property
     def tables(self):
+        self._parseStructures()
         return self._tables
 
     @property
     def content(self):
+        self._parseStructures()
         return self._content
 
     @property
@@ -584,9 +820,256 @@ class Page:
     def id(self):
         return self._id
 
+# Yields one {"Blocks": [...]} dict per PAGE from an iterable of Textract
+# responses (e.g. async result files read one at a time). A page is emitted as
+# soon as the next PAGE block, or the end of the stream, is reached, so only
+# the page being assembled is held in memory.
+def iterDocumentPageBlocks(responsePages):
+    documentPage = None
+    for page in responsePages:
+        for block in page.get('Blocks', []):
+            if(block['BlockType'] == 'PAGE'):
+                if(documentPage):
+                    yield {"Blocks" : documentPage}
+                documentPage = []
+            documentPage.append(block)
+    if(documentPage):
+        yield {"Blocks" : documentPage}
+
+# Streaming counterpart of Document.pages: builds each Page from its own
+# blocks as iterDocumentPageBlocks produces them.
+def iterPages(responsePages):
+    for documentPage in iterDocumentPageBlocks(responsePages):
+        blockMap = {}
+        for block in documentPage["Blocks"]:
+            if('BlockType' in block and 'Id' in block):
+                blockMap[block['Id']] = block
+        yield Page(documentPage["Blocks"], blockMap, lazy=True)
+
+# Read-only sequence of pages that builds each Page on first access
+class LazyPages:
+
+    def __init__(self, documentPages, blockMap):
+        self._documentPages = documentPages
+        self._blockMap = blockMap
+        self._pages = [None] * len(documentPages)
+
+    def __len__(self):
+        return len(self._documentPages)
+
+    def __bool__(self):
+        return len(self._documentPages) > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index = index + len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("page index out of range")
+        page = self._pages[index]
+        if page is None:
+            page = Page(self._documentPages[index]["Blocks"], self._blockMap, lazy=True)
+            self._pages[index] = page
+        return page
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def isLoaded(self, index):
+        return self._pages[index] is not None
+
+    def release(self, index):
+        self._pages[index] = None
+
+# Columnar geometry table for every block of a document that has a bounding
+# box, indexed by block ordinal (row in this table, in response order; blocks
+# without geometry are skipped, so it is not the Document.blocks position).
+# Layout questions such as region queries, overlap and confidence filtering
+# run as NumPy array operations instead of loops over Geometry objects.
+class GeometryStore:
+
+    BLOCK_TYPES = ["PAGE", "LINE", "WORD", "TABLE", "CELL", "KEY_VALUE_SET", "SELECTION_ELEMENT"]
+
+    def __init__(self, documentPages):
+        blockTypeCodes = {t: i for i, t in enumerate(GeometryStore.BLOCK_TYPES)}
+        ids = []
+        rows = []
+        for pageNumber, documentPage in enumerate(documentPages, 1):
+            for block in documentPage["Blocks"]:
+                bb = block.get('Geometry', {}).get('BoundingBox')
+                if not bb:
+                    continue
+                ids.append(block['Id'])
+                rows.append((
+                    bb['Left'], bb['Top'], bb['Width'], bb['Height'],
+                    block.get('Confidence', np.nan),
+                    blockTypeCodes.get(block['BlockType'], -1),
+                    pageNumber
+                ))
+
+        table = np.array(rows, dtype=np.float64).reshape(len(rows), 7)
+        self._ids = ids
+        self._ordinals = {blockId: i for i, blockId in enumerate(ids)}
+        self._left = table[:, 0].copy()
+        self._top = table[:, 1].copy()
+        self._width = table[:, 2].copy()
+        self._height = table[:, 3].copy()
+        self._confidence = table[:, 4].copy()
+        self._blockType = table[:, 5].astype(np.int8)
+        self._page = table[:, 6].astype(np.int32)
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def ids(self):
+        return self._ids
+
+    @property
+    def left(self):
+        return self._left
+
+    @property
+    def top(self):
+        return self._top
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def right(self):
+        return self._left + self._width
+
+    @property
+    def bottom(self):
+        return self._top + self._height
+
+    @property
+    def confidence(self):
+        return self._confidence
+
+    @property
+    def blockType(self):
+        return self._blockType
+
+    @property
+    def page(self):
+        return self._page
+
+    def ordinal(self, blockId):
+        return self._ordinals.get(blockId)
+
+    def idsOf(self, ordinals):
+        return [self._ids[i] for i in ordinals]
+
+    def select(self, blockType=None, page=None, minConfidence=None):
+        mask = np.ones(len(self._ids), dtype=bool)
+        if blockType is not None:
+            mask &= self._blockType == GeometryStore.BLOCK_TYPES.index(blockType)
+        if page is not None:
+            mask &= self._page == page
+        if minConfidence is not None:
+            mask &= self._confidence >= minConfidence
+        return np.nonzero(mask)[0]
+
+    def _boxOf(self, box):
+        if isinstance(box, str):
+            i = self._ordinals[box]
+            return (self._left[i], self._top[i], self._width[i], self._height[i])
+        return box
+
+    def intersectionArea(self, box, ordinals=None):
+        left, top, width, height = self._boxOf(box)
+        if ordinals is None:
+            ordinals = np.arange(len(self._ids))
+        x0 = np.maximum(self._left[ordinals], left)
+        y0 = np.maximum(self._top[ordinals], top)
+        x1 = np.minimum(self._left[ordinals] + self._width[ordinals], left + width)
+        y1 = np.minimum(self._top[ordinals] + self._height[ordinals], top + height)
+        return np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+
+    def overlaps(self, box, ordinals=None, minIoU=0.0):
+        # box is (left, top, width, height) or a block id; returns the ordinals
+        # whose intersection-over-union with it exceeds minIoU
+        left, top, width, height = self._boxOf(box)
+        if ordinals is None:
+            ordinals = np.arange(len(self._ids))
+        inter = self.intersectionArea((left, top, width, height), ordinals)
+        union = self._width[ordinals] * self._height[ordinals] + width * height - inter
+        iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+        return ordinals[(inter > 0) & (iou >= minIoU)]
+
+    def containedIn(self, box, ordinals=None):
+        left, top, width, height = self._boxOf(box)
+        if ordinals is None:
+            ordinals = np.arange(len(self._ids))
+        mask = (self._left[ordinals] >= left) & (self._top[ordinals] >= top) \
+            & (self._left[ordinals] + self._width[ordinals] <= left + width) \
+            & (self._top[ordinals] + self._height[ordinals] <= top + height)
+        return ordinals[mask]
+
+    def regionQuery(self, page, left, top, width, height, blockType=None, contained=True):
+        candidates = self.select(blockType=blockType, page=page)
+        if contained:
+            return self.containedIn((left, top, width, height), candidates)
+        return self.overlaps((left, top, width, height), candidates)
+
+    def columnsInReadingOrder(self, ordinals, spanningFactor=2.0):
+        # Reading order as an interval merge, O(n log n): blocks more than
+        # spanningFactor times the median width (headers, footers) are set
+        # aside, the x-intervals of the rest are sorted by left edge and
+        # merged wherever they overlap, and each merged interval is a column.
+        # Spanning blocks join the column holding their centre, or the one
+        # with the nearest edge. Returns one array of ordinals per column,
+        # left to right, each ordered top to bottom (ties in input order).
+        ordinals = np.asarray(ordinals)
+        if not len(ordinals):
+            return []
+        left = self._left[ordinals]
+        right = left + self._width[ordinals]
+        top = self._top[ordinals]
+        width = right - left
+        spanning = width > np.sort(width)[len(width) // 2] * spanningFactor
+
+        narrow = np.nonzero(~spanning)[0]
+        order = narrow[np.argsort(left[narrow], kind='stable')]
+        reach = np.maximum.accumulate(right[order])
+        # a column starts where a block begins right of everything before it
+        starts = np.concatenate(([True], left[order][1:] > reach[:-1]))
+        startIndexes = np.nonzero(starts)[0]
+        columnLeft = left[order][startIndexes]
+        columnRight = np.maximum.reduceat(right[order], startIndexes)
+
+        column = np.empty(len(ordinals), dtype=np.int64)
+        column[order] = np.cumsum(starts) - 1
+        wide = np.nonzero(spanning)[0]
+        if len(wide):
+            centre = (left[wide] + right[wide]) / 2
+            inside = np.searchsorted(columnLeft, centre, side='right') - 1
+            edgeDistance = np.minimum(np.abs(centre[:, None] - columnLeft[None, :]),
+                                      np.abs(centre[:, None] - columnRight[None, :]))
+            contained = (inside >= 0) & (centre <= columnRight[np.maximum(inside, 0)])
+            column[wide] = np.where(contained, inside, np.argmin(edgeDistance, axis=1))
+
+        positions = np.lexsort((np.arange(len(ordinals)), top, column))
+        boundaries = np.nonzero(np.diff(column[positions]))[0] + 1
+        return [ordinals[group] for group in np.split(positions, boundaries)]
+
+    def sortByPosition(self, ordinals):
+        # top-to-bottom, then left-to-right
+        ordinals = np.asarray(ordinals)
+        return ordinals[np.lexsort((self._left[ordinals], self._top[ordinals]))]
+
 class Document:
 
-    def __init__(self, responsePages):
+    def __init__(self, responsePages, lazy=False):
 
         if(not isinstance(responsePages, list)):
             rps = []
@@ -594,7 +1077,10 @@ class Document:
             responsePages = rps
 
         self._responsePages = responsePages
+        self._lazy = lazy
         self._pages = []
+        self._geometryStore = None
+        self._formIndex = None
 
         self._parse()
 
@@ -629,6 +1115,9 @@ class Document:
     def _parse(self):
 
         self._responseDocumentPages, self._blockMap = self._parseDocumentPagesAndBlockMap()
+        if(self._lazy):
+            self._pages = LazyPages(self._responseDocumentPages, self._blockMap)
+            return
         for documentPage in self._responseDocumentPages:
             page = Page(documentPage["Blocks"], self._blockMap)
             self._pages.append(page)
@@ -645,9 +1134,34 @@ class Document:
     def pages(self):
         return self._pages
 
+    # Form index across every page, built on first use from each page's form
+    @property
+    def formIndex(self):
+        if(self._formIndex is None):
+            formIndex = FormIndex()
+            for page in self._pages:
+                for field in page.form.fields:
+                    formIndex.addField(field)
+            self._formIndex = formIndex
+        return self._formIndex
+
+    # Geometry of every block in the document, built on first use
+    @property
+    def geometryStore(self):
+        if(self._geometryStore is None):
+            self._geometryStore = GeometryStore(self._responseDocumentPages)
+        return self._geometryStore
+
+    # With release=True, lazily built pages are dropped from the document
+    # once the caller moves on to the next one.
+    def iterPages(self, release=False):
+        for index in range(len(self._pages)):
+            yield self._pages[index]
+            if(release and self._lazy):
+                self._pages.release(index)
+
     def getBlockById(self, blockId):
         block = None
         if(self._blockMap and blockId in self._blockMap):
             block = self._blockMap[blockId]
         return block
-
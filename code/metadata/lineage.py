@@ -10,11 +10,13 @@ SQS_QUEUE_ARN = os.environ.get("SQS_QUEUE_ARN", None)
 if not DOCUMENT_LINEAGE_TABLE or not DOCUMENT_LINEAGE_INDEX or not SQS_QUEUE_ARN:
     raise ValueError("Missing arguments.")
 
-def postLineage(lineagePayload, receipt):
-    client = LineageStore(DOCUMENT_LINEAGE_TABLE, DOCUMENT_LINEAGE_INDEX)
-    
+lineageStore = LineageStore(DOCUMENT_LINEAGE_TABLE, DOCUMENT_LINEAGE_INDEX)
+
+def resolveLineage(lineagePayload):
+    # Deletion events carry no documentId; look it up from an earlier
+    # lineage record of the same object. Returns None when there is none.
     if lineagePayload['s3Event'].startswith("ObjectRemoved"):
-        res = client.queryDocumentId(
+        res = lineageStore.queryDocumentId(
             lineagePayload['targetBucketName'],
             lineagePayload['targetFileName'],
             lineagePayload.get('versionId')
@@ -24,48 +26,75 @@ def postLineage(lineagePayload, receipt):
             lineagePayload['documentId'] = actualDocumentId
         elif res['Status'] == 404:
             print("Could not find corresponding documentId for this deletion event")
-            res = SQSHelper().deleteMessage(SQS_QUEUE_ARN, receipt)
-            return res
+            return None
         else:
             raise Exception("Unable to update deletion of document {}/{} Version {}: {}".format(
                 lineagePayload['targetBucketName'], lineagePayload['targetFileName'], lineagePayload.get('versionId'), res['Error']))
-            
-    res = client.createLineage(**lineagePayload)
-    if res['Status'] == 200:
-        SQSHelper().deleteMessage(SQS_QUEUE_ARN, receipt)
-    else:
-        raise Exception("Unable to update progress of document {}: {}".format(lineagePayload['documentId'], res['Error']))
-    return res
+    return lineagePayload
+
+def parseRecord(record):
+    assert record['eventSourceARN'] == SQS_QUEUE_ARN, "Unexpected Lambda event source ARN. Expected {}, got {}".format(SQS_QUEUE_ARN, record['eventSourceARN'])
+    payload = json.loads(record["body"])
+    message = json.loads(payload['Message'])
+    print(message)
+    lineagePayload = {}
+    try:
+        lineagePayload = {
+            "documentId":       message['documentId'],
+            "callerId":         message['callerId'],
+            "targetFileName":   message['targetFileName'],
+            "targetBucketName": message['targetBucketName'],
+            "timestamp":        message['timestamp'],
+            "s3Event":          message['s3Event']
+        }
+        if 'versionId' in message:
+            lineagePayload['versionId'] = message['versionId']
+    except Exception as e:
+        print(e)
+        raise ValueError("Missing parameters in payload to lineage lambda")
+    try:
+        if message['s3Event'] == 'ObjectCreated:Copy':
+            lineagePayload['sourceBucketName'] = message['sourceBucketName']
+            lineagePayload['sourceFileName']   = message['sourceFileName']
+        elif 'sourceBucketName' in message and 'sourceFileName' in message:
+            # Derived outputs (Textract, Comprehend) name their source too
+            lineagePayload['sourceBucketName'] = message['sourceBucketName']
+            lineagePayload['sourceFileName']   = message['sourceFileName']
+        if 'sourceVersionId' in message:
+            lineagePayload['sourceVersionId'] = message['sourceVersionId']
+    except Exception as e:
+        print(e)
+        raise ValueError("Missing parameters from Copy Object S3 notification")
+    return lineagePayload
+
+def writeLineages(payloads):
+    # Deletions are resolved against committed rows, so the upload they
+    # refer to may arrive in the same batch: the batch is written in runs,
+    # each flushed before the next deletion is looked up
+    results = [None] * len(payloads)
+    pending = []
+
+    def flush():
+        if pending:
+            for index, result in zip(pending, lineageStore.createLineages([payloads[index] for index in pending])):
+                results[index] = result
+            del pending[:]
+
+    for index, payload in enumerate(payloads):
+        if payload['s3Event'].startswith("ObjectRemoved"):
+            flush()
+            try:
+                if resolveLineage(payload) is None:
+                    results[index] = {'Status': 200}
+                    continue
+            except Exception as e:
+                print(e)
+                results[index] = {'Status': 500, 'Error': str(e)}
+                continue
+        pending.append(index)
+    flush()
+    return results
 
 def lambda_handler(event, context):
-    for record in event['Records']:
-        print(event)
-        assert record['eventSourceARN'] == SQS_QUEUE_ARN, "Unexpected Lambda event source ARN. Expected {}, got {}".format(SQS_QUEUE_ARN, record['eventSourceARN'])
-        payload = json.loads(record["body"])
-        message = json.loads(payload['Message'])
-        print(message)
-        receipt = record['receiptHandle']
-        lineagePayload = {}
-        try:
-            lineagePayload = {
-                "documentId":       message['documentId'],
-                "callerId":         message['callerId'],
-                "targetFileName":   message['targetFileName'],
-                "targetBucketName": message['targetBucketName'],
-                "timestamp":        message['timestamp'],
-                "s3Event":          message['s3Event']
-            }
-            if 'versionId' in message:
-                lineagePayload['versionId'] = message['versionId']
-        except Exception as e:
-            print(e)
-            raise ValueError("Missing parameters in payload to lineage lambda")
-        try:
-            if message['s3Event'] == 'ObjectCreated:Copy':
-                lineagePayload['sourceBucketName'] = message['sourceBucketName']
-                lineagePayload['sourceFileName']   = message['sourceFileName']
-        except:
-            print(e)
-            raise ValueError("Missing parameters from Copy Object S3 notification")
-        postLineage(lineagePayload, receipt)
-        
\ No newline at end of file
+    print(event)
+    return SQSHelper.processBatchWrites(event['Records'], parseRecord, writeLineages)
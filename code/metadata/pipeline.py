@@ -4,26 +4,25 @@ from datastore import PipelineOpsStore
 from helper import AwsHelper, SQSHelper 
 
 PIPELINE_OPS_TABLE = os.environ.get("PIPELINE_OPS_TABLE", None)
+PIPELINE_OPS_EVENTS_TABLE = os.environ.get("PIPELINE_OPS_EVENTS_TABLE", None)
 SQS_QUEUE_ARN   = os.environ.get("SQS_QUEUE_ARN", None)
 
-if not PIPELINE_OPS_TABLE or not SQS_QUEUE_ARN:
+if not PIPELINE_OPS_TABLE or not PIPELINE_OPS_EVENTS_TABLE or not SQS_QUEUE_ARN:
     raise ValueError("Missing arguments.")
-    
-def startDocumentTracking(documentPayload, receipt):
+
+pipelineStore = PipelineOpsStore(PIPELINE_OPS_TABLE, PIPELINE_OPS_EVENTS_TABLE)
+
+def startDocumentTracking(documentPayload):
     print("Started tracking document {}".format(documentPayload['documentId']))
-    client = PipelineOpsStore(PIPELINE_OPS_TABLE)
     
-    res = client.startDocumentTracking(**documentPayload)
+    res = pipelineStore.startDocumentTracking(**documentPayload)
     print(res)
-    if res['Status'] == 200:
-        SQSHelper().deleteMessage(SQS_QUEUE_ARN, receipt)
-    else:
+    if res['Status'] != 200:
         raise Exception("Unable to post document {}: {}".format(documentPayload['documentId'], res['Error']))
     return res
 
-def updateDocumentStatus(documentPayload, receipt, messageNote=None):
+def updateDocumentStatus(documentPayload, messageNote=None):
     print("Putting pipeline document status update")
-    client = PipelineOpsStore(PIPELINE_OPS_TABLE)
     if messageNote:
         statusPayload = {
             "documentId": documentPayload['documentId'],
@@ -39,37 +38,35 @@ def updateDocumentStatus(documentPayload, receipt, messageNote=None):
             "stage":      documentPayload['stage'],
             "timestamp":  documentPayload['timestamp']
         }
-    res = client.updateDocumentStatus(**statusPayload)
+    res = pipelineStore.updateDocumentStatus(**statusPayload)
     print(res)
-    if res['Status'] == 200:
-        SQSHelper().deleteMessage(SQS_QUEUE_ARN, receipt)
-    else:
+    if res['Status'] != 200:
         raise Exception("Unable to update status of document {}: {}".format(statusPayload['documentId'], res['Error']))
     return res
 
+def processRecord(record):
+    assert record['eventSourceARN'] == SQS_QUEUE_ARN, "Unexpected Lambda event source ARN. Expected {}, got {}".format(SQS_QUEUE_ARN, record['eventSourceARN'])
+    payload = json.loads(record["body"])
+    message = json.loads(payload['Message'])
+    print(message)
+    try:
+        documentPayload = {
+            "documentId": message['documentId'],
+            "bucketName": message['bucketName'],
+            "objectName": message['objectName'],
+            "status":     message['status'],
+            "stage":      message['stage'],
+            "timestamp":  message['timestamp'],
+        }
+    except Exception as e:
+        print("Missing " + str(e))
+        raise ValueError("Missing parameters in payload to pipeline metadata lambda")
+    if 'initDoc' in message and message.get('initDoc') == "True":
+        startDocumentTracking(documentPayload)
+    else:
+        messageNote = message.get('message')
+        updateDocumentStatus(documentPayload, messageNote)
+
 def lambda_handler(event, context):
-    for record in event['Records']:
-        print(event)
-        assert record['eventSourceARN'] == SQS_QUEUE_ARN, "Unexpected Lambda event source ARN. Expected {}, got {}".format(SQS_QUEUE_ARN, record['eventSourceARN'])
-        payload = json.loads(record["body"])
-        message = json.loads(payload['Message'])
-        receipt = record['receiptHandle']
-        print(message)
-        try:
-            documentPayload = {
-                "documentId": message['documentId'],
-                "bucketName": message['bucketName'],
-                "objectName": message['objectName'],
-                "status":     message['status'],
-                "stage":      message['stage'],
-                "timestamp":  message['timestamp'],
-            }
-        except Exception as e:
-            print("Missing " + str(e))
-            raise ValueError("Missing parameters in payload to pipeline metadata lambda")
-        if 'initDoc' in message and message.get('initDoc') == "True":
-            startDocumentTracking(documentPayload, receipt)
-        else:
-            messageNote = message.get('message')
-            updateDocumentStatus(documentPayload, receipt, messageNote)
-            
\ No newline at end of file
+    print(event)
+    return SQSHelper.processBatch(event['Records'], processRecord)
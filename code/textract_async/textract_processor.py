@@ -4,7 +4,7 @@ import boto3
 import time
 from helper import AwsHelper, S3Helper
 from og import OutputGenerator
-from metadata import PipelineOperationsClient, DocumentLineageClient
+from metadata import PipelineOperationsClient, DocumentLineageClient, flushesMetadata
 
 PIPELINE_STAGE = "ASYNC_PROCESS_TEXTRACT"
 
@@ -17,49 +17,23 @@ if not textractBucketName or not metadataTopic:
 pipeline_client = PipelineOperationsClient(metadataTopic)
 lineage_client = DocumentLineageClient(metadataTopic)
 
-def getJobResults(api, jobId, objectName):
-
-    resultJSON = []
-
-    s3_helper = S3Helper()
-    textractRawResultsFiles = s3_helper.listObjectsInS3(
+def listJobResults(jobId, objectName):
+    textractRawResultsFiles = S3Helper().listObjectsInS3(
         bucketName   = textractBucketName,
         bucketPrefix = objectName + "/textract-output/" + jobId
     )
-    # skip the s3 access file, which will always appear first
-    for textractResultFile in textractRawResultsFiles[1:]:
-        resultJSON.append(json.loads(s3_helper.readFromS3(textractBucketName, textractResultFile)))
-    
-    # time.sleep(5)
-
-    # client = AwsHelper().getClient('textract')
-    # if(api == "StartDocumentTextDetection"):
-    #     response = client.get_document_text_detection(JobId=jobId)
-    # else:
-    #     response = client.get_document_analysis(JobId=jobId)
-    # pages.append(response)
-    # print("Resultset page received: {}".format(len(pages)))
-    # nextToken = None
-    # if('NextToken' in response):
-    #     nextToken = response['NextToken']
-    #     print("Next token: {}".format(nextToken))
-
-    # while(nextToken):
-    #     time.sleep(5)
-
-    #     if(api == "StartDocumentTextDetection"):
-    #         response = client.get_document_text_detection(JobId=jobId, NextToken=nextToken)
-    #     else:
-    #         response = client.get_document_analysis(JobId=jobId, NextToken=nextToken)
-
-    #     pages.append(response)
-    #     print("Resultset page received: {}".format(len(pages)))
-    #     nextToken = None
-    #     if('NextToken' in response):
-    #         nextToken = response['NextToken']
-    #         print("Next token: {}".format(nextToken))
-
-    return resultJSON
+    # Result files are named 1, 2, ..., N; order them numerically (S3 lists
+    # them lexicographically) and skip the s3 access check file
+    textractResultFiles = [f for f in textractRawResultsFiles if os.path.basename(f).isdigit()]
+    textractResultFiles.sort(key=lambda f: int(os.path.basename(f)))
+    return textractResultFiles
+
+def streamJobResults(textractResultFiles):
+    # Result files are read and parsed one at a time, in order, so only a
+    # single file's JSON is in memory while the output generator consumes it
+    s3_helper = S3Helper()
+    for textractResultFile in textractResultFiles:
+        yield json.loads(s3_helper.readFromS3(textractBucketName, textractResultFile))
 
 def processRequest(request):
 
@@ -83,12 +57,12 @@ def processRequest(request):
     
     pipeline_client.stageInProgress()
     try:
-       resultJSON = getJobResults(jobAPI, jobId, objectName)
+       textractResultFiles = listJobResults(jobId, objectName)
     except Exception as e:
         pipeline_client.stageFailed("Textract job for document ID {}; bucketName {} filename {} failed during Textract processing. Could not read Textract output files under job Name {}".format(jobTag, bucketName, objectName, jobId))
         raise Exception("Textract Analysis didn't complete successfully")
         
-    print("Result Textract result objects received: {}".format(len(resultJSON)))
+    print("Result Textract result objects received: {}".format(len(textractResultFiles)))
 
     detectForms = False
     detectTables = False
@@ -99,7 +73,7 @@ def processRequest(request):
     try:
         opg = OutputGenerator(
             documentId = jobTag,
-            response   = resultJSON,
+            response   = streamJobResults(textractResultFiles),
             bucketName = textractBucketName,
             objectName = objectName,
             forms      = detectForms,
@@ -109,8 +83,13 @@ def processRequest(request):
         pipeline_client.stageFailed("Could not convert results from Textract into processable object. Try uploading again.")
         raise(e)
         
-    tagging = "documentId={}".format(jobTag)
-    opg.writeTextractOutputs(taggingStr=tagging)
+    try:
+        # The source copy carries the upload's tags, including documentVersion
+        documentVersion = S3Helper().getTagsS3(bucketName, objectName).get('documentVersion', None)
+        opg.writeTextractOutputs(taggingStr=S3Helper.documentTagging(jobTag, documentVersion))
+    except Exception as e:
+        pipeline_client.stageFailed("Textract job for document ID {}; bucketName {} filename {} failed while reading or writing Textract output under job Name {}".format(jobTag, bucketName, objectName, jobId))
+        raise(e)
     
     lineage_client.recordLineage({
         "documentId":       jobTag,
@@ -118,7 +97,7 @@ def processRequest(request):
         "sourceBucketName": bucketName,
         "targetBucketName": textractBucketName,
         "sourceFileName":   objectName,
-        "targetFileName":   objectName
+        "targetFileName":   "{}/fullresponse.json".format(opg.outputPath)
     })
     
     output = "Processed -> Document: {}, Object: {}/{} processed.".format(jobTag, bucketName, objectName)
@@ -129,6 +108,7 @@ def processRequest(request):
         'body': output
     }
 
+@flushesMetadata
 def lambda_handler(event, context):
 
     print("event: {}".format(event))
@@ -4,7 +4,7 @@ import os
 import urllib.parse
 from helper import AwsHelper, S3Helper
 import time
-from metadata import PipelineOperationsClient
+from metadata import PipelineOperationsClient, flushesMetadata
 
 PIPELINE_STAGE = "ASYNC_START_TEXTRACT"
 
@@ -72,6 +72,7 @@ def processItem(bucketName, objectName, snsTopic, snsRole):
     return jobId
     
 
+@flushesMetadata
 def lambda_handler(event, context):
     if 's3' in event['Records'][0]:
         print("Async Processor event: {}".format(event))
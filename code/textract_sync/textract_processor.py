@@ -4,7 +4,7 @@ import json
 import os
 import urllib.parse
 from helper import AwsHelper, S3Helper, DynamoDBHelper
-from metadata import PipelineOperationsClient, DocumentLineageClient
+from metadata import PipelineOperationsClient, DocumentLineageClient, flushesMetadata
 from og import OutputGenerator
 
 PIPELINE_STAGE = "SYNC_PROCESS_TEXTRACT"
@@ -31,7 +31,7 @@ def callTextract(bucketName, objectName):
     return response
 
 
-def processImage(documentId, bucketName, objectName, callerId):
+def processImage(documentId, bucketName, objectName, callerId, documentVersion=None):
 
     response = callTextract(bucketName, objectName)
 
@@ -45,7 +45,7 @@ def processImage(documentId, bucketName, objectName, callerId):
         forms      = False,
         tables     = False
     )
-    tagging = "documentId={}".format(documentId)
+    tagging = S3Helper.documentTagging(documentId, documentVersion)
     opg.writeTextractOutputs(taggingStr=tagging)
     
     lineage_client.recordLineage({
@@ -54,7 +54,7 @@ def processImage(documentId, bucketName, objectName, callerId):
         "sourceBucketName": bucketName,
         "targetBucketName": textractBucketName,
         "sourceFileName":   objectName,
-        "targetFileName":   objectName
+        "targetFileName":   "{}/fullresponse.json".format(opg.outputPath)
     })
 
 # --------------- Main handler ------------------
@@ -63,7 +63,8 @@ def processRequest(bucketName, objectName, callerId):
 
     output = ""
 
-    documentId = S3Helper().getTagsS3(bucketName, objectName).get('documentId', None)
+    tags = S3Helper().getTagsS3(bucketName, objectName)
+    documentId = tags.get('documentId', None)
     if not documentId:
         raise Exception("Unidentified document. Please check its tags.")
     
@@ -80,7 +81,7 @@ def processRequest(bucketName, objectName, callerId):
     if(documentId and bucketName and objectName):
         print("DocumentId: {}, Object: {}/{}".format(documentId, bucketName, objectName))
 
-        processImage(documentId, bucketName, objectName, callerId)
+        processImage(documentId, bucketName, objectName, callerId, tags.get('documentVersion', None))
 
         output = "Document: {}, Object: {}/{} processed.".format(documentId, bucketName, objectName)
         pipeline_client.stageSucceeded()
@@ -93,6 +94,7 @@ def processRequest(bucketName, objectName, callerId):
         'body': output
     }
 
+@flushesMetadata
 def lambda_handler(event, context):
 
     print("Sync Processor event: {}".format(event))
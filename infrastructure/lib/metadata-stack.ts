@@ -8,6 +8,7 @@ import lambda = require('@aws-cdk/aws-lambda');
 
 export class MetadataStack extends cdk.Stack {
   public readonly pipelineOpsTable : dynamodb.Table;
+  public readonly pipelineOpsEventsTable : dynamodb.Table;
   public readonly lineageTable : dynamodb.Table;
   public readonly indexName : string;
   public readonly documentRegistryTable : dynamodb.Table;
@@ -68,6 +69,31 @@ export class MetadataStack extends cdk.Stack {
       removalPolicy: cdk.RemovalPolicy.DESTROY
     });
 
+    //Sparse index over documents that are IN_PROGRESS or FAILED, sharded per status
+    this.pipelineOpsTable.addGlobalSecondaryIndex({
+      indexName: "DocumentStatusIndex",
+      partitionKey: { name: 'statusShard', type: dynamodb.AttributeType.STRING },
+      sortKey:  { name: 'stageUpdate', type: dynamodb.AttributeType.STRING },
+      projectionType: dynamodb.ProjectionType.INCLUDE,
+      nonKeyAttributes: ['bucketName', 'objectName', 'documentStatus', 'documentStage', 'lastUpdate']
+    });
+
+    //Same sparse partitions sorted by lastUpdate alone, for update ranges across stages
+    this.pipelineOpsTable.addGlobalSecondaryIndex({
+      indexName: "DocumentUpdateIndex",
+      partitionKey: { name: 'statusShard', type: dynamodb.AttributeType.STRING },
+      sortKey:  { name: 'lastUpdate', type: dynamodb.AttributeType.STRING },
+      projectionType: dynamodb.ProjectionType.INCLUDE,
+      nonKeyAttributes: ['bucketName', 'objectName', 'documentStatus', 'documentStage']
+    });
+
+    //Pipeline status history, one item per status change
+    this.pipelineOpsEventsTable = new dynamodb.Table(this, 'PipelineOpsEventsTable', {
+      partitionKey: { name: 'documentId', type: dynamodb.AttributeType.STRING },
+      sortKey: { name: 'eventKey', type: dynamodb.AttributeType.STRING },
+      removalPolicy: cdk.RemovalPolicy.DESTROY
+    });
+
     const indexName = "DocumentSignatureIndex";
     
     //DynamoDB table with links to output in S3
@@ -83,6 +109,14 @@ export class MetadataStack extends cdk.Stack {
       sortKey:  { name: 'timestamp', type: dynamodb.AttributeType.STRING },
       projectionType: dynamodb.ProjectionType.KEYS_ONLY
     });
+
+    //Sparse index over rows that name a source, for walking lineage downstream
+    this.lineageTable.addGlobalSecondaryIndex({
+      indexName: "SourceSignatureIndex",
+      partitionKey: { name: 'sourceSignature', type: dynamodb.AttributeType.STRING },
+      sortKey:  { name: 'timestamp', type: dynamodb.AttributeType.STRING },
+      projectionType: dynamodb.ProjectionType.KEYS_ONLY
+    });
     
     this.documentRegistryTable = new dynamodb.Table(this, 'DocumentRegistryTable', {
       partitionKey: { name: 'documentId', type: dynamodb.AttributeType.STRING },
@@ -116,7 +150,8 @@ export class MetadataStack extends cdk.Stack {
     documentLineageFunction.addLayers(metadataserviceLayer)
     //Triggers
     documentLineageFunction.addEventSource(new SqsEventSource(this.lineageSQS, {
-      batchSize: 1
+      batchSize: 10,
+      reportBatchItemFailures: true
     }));
     //Permissions
     this.lineageTable.grantReadWriteData(documentLineageFunction)
@@ -131,6 +166,7 @@ export class MetadataStack extends cdk.Stack {
       timeout: cdk.Duration.seconds(30),
       environment: {
         PIPELINE_OPS_TABLE: this.pipelineOpsTable.tableName,
+        PIPELINE_OPS_EVENTS_TABLE: this.pipelineOpsEventsTable.tableName,
         SQS_QUEUE_ARN: this.pipelineOpsSQS.queueArn
       }
     });
@@ -138,10 +174,12 @@ export class MetadataStack extends cdk.Stack {
     pipelineOpsFunction.addLayers(metadataserviceLayer)
     //Triggers
     pipelineOpsFunction.addEventSource(new SqsEventSource(this.pipelineOpsSQS, {
-      batchSize: 1
+      batchSize: 10,
+      reportBatchItemFailures: true
     }));
     //Permissions
     this.pipelineOpsTable.grantReadWriteData(pipelineOpsFunction)
+    this.pipelineOpsEventsTable.grantReadWriteData(pipelineOpsFunction)
     this.pipelineOpsSQS.grantConsumeMessages(pipelineOpsFunction)
     
     const documentRegistryFunction = new lambda.Function(this, 'DocumentRegistrationFunction', {
@@ -158,7 +196,8 @@ export class MetadataStack extends cdk.Stack {
     documentRegistryFunction.addLayers(metadataserviceLayer)
     //Triggers
     documentRegistryFunction.addEventSource(new SqsEventSource(this.documentRegistrySQS, {
-      batchSize: 1
+      batchSize: 10,
+      reportBatchItemFailures: true
     }));
     //Permissions
     this.documentRegistryTable.grantReadWriteData(documentRegistryFunction)
@@ -78,7 +78,8 @@ export class TextractPipelineStack extends cdk.Stack {
       handler: 'document_registrar.lambda_handler',
       timeout: cdk.Duration.seconds(30),
       environment: {
-        METADATA_SNS_TOPIC_ARN : props.metadataTopic.topicArn
+        METADATA_SNS_TOPIC_ARN : props.metadataTopic.topicArn,
+        TARGET_ES_CLUSTER: props.esDomain.domainEndpoint
       }
     });
     //Layer
@@ -93,6 +94,12 @@ export class TextractPipelineStack extends cdk.Stack {
 
     //Permissions
     rawContentsBucket.grantReadWrite(documentRegistrar)
+    documentRegistrar.addToRolePolicy(
+      new iam.PolicyStatement({
+        actions: ["es:ESHttpPost"],
+        resources: ["*"]
+      })
+    );
     
     documentRegistrar.addToRolePolicy(
       new iam.PolicyStatement({
@@ -274,6 +281,45 @@ export class TextractPipelineStack extends cdk.Stack {
 
     //--------------
 
+    // ES indexing buffer: comprehend_sync queues page documents and the
+    // indexer drains them in large bulk requests
+    const esIndexingDLQ = new sqs.Queue(this, 'ESIndexingDLQ', {
+      retentionPeriod: cdk.Duration.seconds(1209600)
+    });
+    const esIndexingQueue = new sqs.Queue(this, 'ESIndexingQueue', {
+      visibilityTimeout: cdk.Duration.seconds(720), retentionPeriod: cdk.Duration.seconds(1209600),
+      deadLetterQueue: { queue: esIndexingDLQ, maxReceiveCount: 5 }
+    });
+
+    const esIndexer = new lambda.Function(this, 'ESIndexer', {
+      runtime: lambda.Runtime.PYTHON_3_7,
+      code: lambda.Code.asset('code/es_indexer'),
+      handler: 'es_indexer.lambda_handler',
+      memorySize: 1024,
+      timeout: cdk.Duration.seconds(120),
+      environment: {
+        TARGET_ES_CLUSTER: props.esDomain.domainEndpoint
+      }
+    });
+    //Layer
+    esIndexer.addLayers(pipelineLayer)
+    //Trigger
+    esIndexer.addEventSource(new SqsEventSource(esIndexingQueue, {
+      batchSize: 500,
+      maxBatchingWindow: cdk.Duration.seconds(30),
+      reportBatchItemFailures: true
+    }));
+    //Permissions
+    esIndexingQueue.grantConsumeMessages(esIndexer)
+    esIndexer.addToRolePolicy(
+      new iam.PolicyStatement({
+        actions: ["es:*"],
+        resources: ["*"]
+      })
+    );
+
+    //--------------
+
     // Comprehend Lambda
     const comprehendSyncProcessor = new lambda.Function(this, 'ComprehendSyncProcessor', {
       runtime: lambda.Runtime.PYTHON_3_7,
@@ -284,7 +330,8 @@ export class TextractPipelineStack extends cdk.Stack {
       environment: {
         TARGET_ES_CLUSTER: props.esDomain.domainEndpoint,
         TARGET_COMPREHEND_BUCKET: comprehendResultsBucket.bucketName,
-        METADATA_SNS_TOPIC_ARN : props.metadataTopic.topicArn
+        METADATA_SNS_TOPIC_ARN : props.metadataTopic.topicArn,
+        ES_INDEX_QUEUE_URL : esIndexingQueue.queueUrl
       }
     });
     //Layer
@@ -297,6 +344,7 @@ export class TextractPipelineStack extends cdk.Stack {
     //Permissions
     textractResultsBucket.grantReadWrite(comprehendSyncProcessor)
     comprehendResultsBucket.grantReadWrite(comprehendSyncProcessor)
+    esIndexingQueue.grantSendMessages(comprehendSyncProcessor)
     comprehendSyncProcessor.addToRolePolicy(
       new iam.PolicyStatement({
         actions: ["es:*"],